@@ -0,0 +1,109 @@
+"""Time fetching scattered frames from a long clip
+
+Compares seeking to every wanted frame with cap.set (the old decode path),
+the FrameReader without a keyframe index (SEEK_DISTANCE heuristic) and the
+FrameReader with the keyframe index.
+
+    python benchmarks/frame_access.py [--video clip.mp4] [--frames 25]
+
+Without --video a 5 minute 640x360 H.264 clip with 250-frame GOPs is
+generated with ffmpeg.
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+
+from pipeline import SERVER_DIR
+
+
+def make_clip(server, path, seconds, fps=30, gop=250):
+    subprocess.run([server.FFMPEG_BINARY, '-v', 'error', '-y', '-f', 'lavfi',
+                    '-i', f'testsrc2=size=640x360:rate={fps}', '-t', str(seconds),
+                    '-c:v', 'libx264', '-preset', 'ultrafast', '-g', str(gop),
+                    '-pix_fmt', 'yuv420p', path], check=True)
+
+
+def seek_every_frame(server, video_path, indices):
+    """The old approach: one cap.set per wanted frame"""
+    cap = cv2.VideoCapture(video_path)
+    frames = {}
+    for i in indices:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, i)
+        ret, frame = cap.read()
+        if ret:
+            frames[i] = frame
+    cap.release()
+    return frames
+
+
+def reader_without_index(server, video_path, indices):
+    with contextlib.closing(server.FrameReader(video_path)) as reader:
+        reader.keyframes = None
+        return reader.read_many(indices)
+
+
+def reader_with_index(server, video_path, indices):
+    with contextlib.closing(server.FrameReader(video_path)) as reader:
+        return reader.read_many(indices)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--video', help='clip to read, generated when omitted')
+    parser.add_argument('--frames', type=int, default=25, help='number of scattered frames to fetch')
+    parser.add_argument('--seconds', type=int, default=300, help='length of the generated clip')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per method, the best is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    video_path = os.path.abspath(args.video) if args.video else None
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # As in pipeline.py, the server keeps its folders in the temporary directory
+        os.chdir(temp_dir)
+        sys.path.insert(0, SERVER_DIR)
+        with contextlib.redirect_stdout(io.StringIO()):
+            import server
+
+        if video_path is None:
+            video_path = os.path.join(temp_dir, 'clip.mp4')
+            print(f"Generating {args.seconds}s clip...")
+            make_clip(server, video_path, args.seconds)
+
+        cap = cv2.VideoCapture(video_path)
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+        indices = sorted(random.Random(args.seed).sample(range(frame_count), min(args.frames, frame_count)))
+
+        start = time.perf_counter()
+        keyframes = server.keyframe_index(video_path)
+        index_time = time.perf_counter() - start
+        print(f"{frame_count} frames, {len(keyframes) if keyframes is not None else 'no'} keyframes "
+              f"(index built in {index_time * 1000:.1f} ms), fetching {len(indices)} frames")
+
+        results = {}
+        for name, method in (('cap.set per frame', seek_every_frame),
+                             ('reader, no index', reader_without_index),
+                             ('reader, keyframe index', reader_with_index)):
+            best = None
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                frames = method(server, video_path, indices)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            results[name] = best
+            print(f"{name:<24} {best:8.3f} s  ({len(frames)} frames)")
+
+        baseline = results['cap.set per frame']
+        print(f"keyframe index speedup over cap.set per frame: {baseline / results['reader, keyframe index']:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
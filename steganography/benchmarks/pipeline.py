@@ -0,0 +1,260 @@
+"""Time every stage of the encode and decode pipelines on synthetic clips
+
+Clips are generated locally with cv2.VideoWriter, so runs are reproducible
+without any sample media:
+
+    python benchmarks/pipeline.py --sizes 480p,720p --frames 30 --output run.json
+    python benchmarks/pipeline.py --baseline run.json   # compare against an earlier run
+
+Each stage is timed on its own, --repeat times, and reported with the median
+time, throughput (frames/s and MB/s of raw BGR frames) and the peak RSS seen
+while it ran. With --baseline the exit status is 1 if any stage got slower
+than the --threshold allows.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+SIZES = {
+    '480p': (854, 480),
+    '720p': (1280, 720),
+    '1080p': (1920, 1080),
+    '4k': (3840, 2160),
+}
+
+TEXT = "Benchmark payload " * 8
+
+
+def make_clip(path, width, height, frames, fps=30, seed=0):
+    """Write a clip of moving gradients with a little noise, so codecs have real work"""
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError("cv2.VideoWriter could not open the mp4v encoder")
+    for i in range(frames):
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[..., 0] = (x + i * 4) % 256
+        frame[..., 1] = (y + i * 2) % 256
+        frame[..., 2] = ((x + y) / 2 + i) % 256
+        frame += rng.integers(0, 8, size=frame.shape, dtype=np.uint8)
+        writer.write(frame)
+    writer.release()
+
+
+def rss_bytes():
+    """Current resident set size"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # ru_maxrss is the lifetime peak (KiB on Linux, bytes on macOS)
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class PeakRSS:
+    """Samples the RSS in the background while a stage runs"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, rss_bytes())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = rss_bytes()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_bytes())
+
+
+def timed(func, quiet=True):
+    """Run func once, returning (seconds, peak RSS, result)"""
+    output = io.StringIO() if quiet else sys.stdout
+    with PeakRSS() as rss, contextlib.redirect_stdout(output):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+    return elapsed, rss.peak, result
+
+
+def bench_clip(server, work_dir, label, width, height, frames, repeat):
+    """Time every stage on one clip, returning a list of stage results"""
+    clip = os.path.join(work_dir, f"{label}_{frames}.mp4")
+    make_clip(clip, width, height, frames)
+    frame_bytes = width * height * 3
+    encrypted = server.encrypt_rsa(TEXT)
+    data = f"STEGO:{TEXT}"
+    results = []
+
+    def record(stage, runs, items, item_bytes):
+        seconds = statistics.median(run[0] for run in runs)
+        entry = {
+            "clip": label,
+            "width": width,
+            "height": height,
+            "frames": frames,
+            "stage": stage,
+            "seconds": seconds,
+            "seconds_min": min(run[0] for run in runs),
+            "items": items,
+            "items_per_s": items / seconds if seconds else None,
+            "mb_per_s": items * item_bytes / 1e6 / seconds if seconds and item_bytes else None,
+            "peak_rss_mb": max(run[1] for run in runs) / 1e6,
+        }
+        results.append(entry)
+        rate = f"{entry['items_per_s']:10.1f}/s" if entry['items_per_s'] else ''
+        mbps = f"{entry['mb_per_s']:9.1f} MB/s" if entry['mb_per_s'] else ''
+        print(f"  {stage:<22} {seconds * 1000:10.1f} ms {rate} {mbps} {entry['peak_rss_mb']:8.0f} MB RSS")
+        return runs[-1][2]
+
+    def run(func):
+        return [timed(func) for _ in range(repeat)]
+
+    print(f"{label} ({width}x{height}, {frames} frames)")
+
+    decoded = record('extract_frames', run(lambda: list(server.extract_frames(clip)[0])), frames, frame_bytes)
+    total = len(decoded)
+
+    bordered = record('create_data_border', run(
+        lambda: [server.create_data_border(frame, data, i, total) for i, frame in enumerate(decoded)]),
+        total, frame_bytes)
+
+    # encode_frames works in place, so every run gets fresh copies
+    encode_runs = []
+    for _ in range(repeat):
+        copies = [frame.copy() for frame in bordered]
+        encode_runs.append(timed(lambda: list(server.encode_frames(iter(copies), encrypted, total_frames=total))))
+    encoded = record('encode_frames', encode_runs, total, frame_bytes)
+
+    output_base = os.path.join(work_dir, f"encoded_{label}")
+    mov_path = record('create_output_video', run(
+        lambda: server.create_output_video(iter(encoded), clip, output_base, formats=('mov',))['mov']),
+        total, frame_bytes)
+
+    record('convert_to_mp4', run(lambda: server.convert_to_mp4(mov_path, work_dir)), total, frame_bytes)
+
+    samples = len(server.border_sample_indices(total))
+    record('extract_border_data', run(lambda: server.extract_border_data(mov_path)), samples, frame_bytes)
+
+    text = record('decode_video', run(lambda: server.decode_video(mov_path)), total, frame_bytes)
+    if text != TEXT:
+        print(f"  [WARNING] decode_video returned {text[:40]!r}")
+
+    operations = 20
+    record('encrypt_rsa', run(lambda: [server.encrypt_rsa(TEXT) for _ in range(operations)]), operations, 0)
+    record('decrypt_rsa', run(lambda: [server.decrypt_rsa(encrypted) for _ in range(operations)]), operations, 0)
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=SERVER_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+
+def compare(results, baseline_path, threshold):
+    """Print the change of every stage against a baseline run; returns the number of regressions"""
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    previous = {(r['clip'], r['frames'], r['stage']): r for r in baseline['results']}
+
+    regressions = 0
+    print(f"\nCompared with {baseline_path} ({baseline['environment'].get('commit') or 'unknown commit'})")
+    for result in results:
+        old = previous.get((result['clip'], result['frames'], result['stage']))
+        if old is None:
+            continue
+        ratio = result['seconds'] / old['seconds'] if old['seconds'] else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f"  {result['clip']:<6} {result['stage']:<22} {old['seconds'] * 1000:10.1f} ms -> "
+              f"{result['seconds'] * 1000:10.1f} ms  x{ratio:5.2f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='480p,720p,1080p,4k',
+                        help=f"comma separated clip sizes out of {', '.join(SIZES)}")
+    parser.add_argument('--frames', default='30', help='comma separated clip lengths in frames')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage, the median is reported')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='relative slowdown counted as a regression (default 0.10)')
+    args = parser.parse_args()
+
+    sizes = [size.strip().lower() for size in args.sizes.split(',') if size.strip()]
+    unknown = [size for size in sizes if size not in SIZES]
+    if unknown:
+        parser.error(f"unknown sizes: {', '.join(unknown)}")
+    lengths = [int(frames) for frames in args.frames.split(',')]
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        # The server keeps its keys, caches and scratch folders relative to the
+        # working directory, so it runs inside the temporary directory
+        os.chdir(work_dir)
+        sys.path.insert(0, SERVER_DIR)
+        with contextlib.redirect_stdout(io.StringIO()):
+            import server
+
+        results = []
+        for size in sizes:
+            width, height = SIZES[size]
+            for frames in lengths:
+                results.extend(bench_clip(server, work_dir, size, width, height, frames, args.repeat))
+
+    report = {"environment": environment(), "settings": vars(args), "results": results}
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f"\nWrote {output}")
+
+    if baseline and compare(results, baseline, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Compare the output profiles on encode speed, size and payload survival
+
+Every profile writes the same bordered, LSB-encoded frames of synthetic
+clips, and every output is decoded again:
+
+    python benchmarks/profiles.py --sizes 480p,720p --frames 60 --trials 3 --output profiles.json
+
+Reported per clip size and profile: median encode time and frames/s,
+output size relative to the raw BGR frames, and the share of trials whose
+LSB payload and whose border data came back intact.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+
+from pipeline import SERVER_DIR, SIZES, environment, make_clip, timed
+
+
+def bench_profile(server, clip, work_dir, profile, frames, text):
+    """Write one profile from prepared frames and decode it, returning a trial result"""
+    base = os.path.join(work_dir, 'out')
+    seconds, rss, paths = timed(lambda: server.create_output_video(iter(frames), clip, base, formats=(profile,)))
+    path = paths[profile]
+    with contextlib.redirect_stdout(io.StringIO()):
+        decoded = server.decrypt_video_file(path)
+    trial = {
+        "seconds": seconds,
+        "peak_rss_mb": rss / 1e6,
+        "bytes": os.path.getsize(path),
+        "lsb_ok": decoded.get("stego_data") == text,
+        "border_ok": (decoded.get("border_data") or '').startswith(f"STEGO:{text}"),
+    }
+    os.remove(path)
+    return trial
+
+
+def bench_size(server, work_dir, label, width, height, frame_count, profiles, trials):
+    """Run every profile on trials clips of one size, returning one summary per profile"""
+    runs = {profile: [] for profile in profiles}
+    for trial in range(trials):
+        clip = os.path.join(work_dir, f"{label}_{trial}.mp4")
+        make_clip(clip, width, height, frame_count, seed=trial)
+        text = f"Profile trial {trial} {os.urandom(4).hex()}"
+
+        # Border and LSB stages once, shared by all profiles
+        with contextlib.redirect_stdout(io.StringIO()):
+            decoded = list(server.extract_frames(clip)[0])
+            total = len(decoded)
+            bordered = [server.create_data_border(frame, f"STEGO:{text}", i, total) for i, frame in enumerate(decoded)]
+            frames = list(server.encode_frames(iter(bordered), server.encrypt_rsa(text), total_frames=total))
+
+        for profile in profiles:
+            runs[profile].append(bench_profile(server, clip, work_dir, profile, frames, text))
+        os.remove(clip)
+
+    raw_bytes = width * height * 3 * frame_count
+    results = []
+    print(f"{label} ({width}x{height}, {frame_count} frames, {trials} trials)")
+    print(f"  {'profile':<10} {'encode':>10} {'frames/s':>9} {'size':>9} {'of raw':>7} {'LSB':>5} {'border':>7}")
+    for profile, trial_runs in runs.items():
+        seconds = statistics.median(run["seconds"] for run in trial_runs)
+        size = statistics.median(run["bytes"] for run in trial_runs)
+        entry = {
+            "clip": label,
+            "width": width,
+            "height": height,
+            "frames": frame_count,
+            "profile": profile,
+            "settings": server.OUTPUT_PROFILES[profile],
+            "seconds": seconds,
+            "frames_per_s": frame_count / seconds if seconds else None,
+            "bytes": size,
+            "size_ratio": size / raw_bytes,
+            "peak_rss_mb": max(run["peak_rss_mb"] for run in trial_runs),
+            "lsb_success": sum(run["lsb_ok"] for run in trial_runs) / trials,
+            "border_success": sum(run["border_ok"] for run in trial_runs) / trials,
+        }
+        results.append(entry)
+        print(f"  {profile:<10} {seconds * 1000:7.0f} ms {entry['frames_per_s']:9.1f} {size / 1e6:6.2f} MB "
+              f"{entry['size_ratio']:6.1%} {entry['lsb_success']:5.0%} {entry['border_success']:7.0%}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='480p,720p', help=f"comma separated clip sizes out of {', '.join(SIZES)}")
+    parser.add_argument('--frames', type=int, default=60, help='frames per clip')
+    parser.add_argument('--trials', type=int, default=3, help='clips per size, each with its own text')
+    parser.add_argument('--profiles', help='comma separated profiles to compare (default all)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    sizes = [size.strip().lower() for size in args.sizes.split(',') if size.strip()]
+    unknown = [size for size in sizes if size not in SIZES]
+    if unknown:
+        parser.error(f"unknown sizes: {', '.join(unknown)}")
+    output = os.path.abspath(args.output) if args.output else None
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        # As in pipeline.py, the server keeps its folders in the temporary directory
+        os.chdir(work_dir)
+        sys.path.insert(0, SERVER_DIR)
+        with contextlib.redirect_stdout(io.StringIO()):
+            import server
+
+        profiles = list(server.OUTPUT_PROFILES)
+        if args.profiles:
+            profiles = [profile.strip() for profile in args.profiles.split(',') if profile.strip()]
+            unknown = [profile for profile in profiles if profile not in server.OUTPUT_PROFILES]
+            if unknown:
+                parser.error(f"unknown profiles: {', '.join(unknown)}")
+
+        results = []
+        for size in sizes:
+            width, height = SIZES[size]
+            results.extend(bench_size(server, work_dir, size, width, height, args.frames, profiles, args.trials))
+
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump({"environment": environment(), "settings": vars(args), "results": results}, output_file, indent=2)
+        print(f"\nWrote {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""Encode or verify whole directories of videos without the HTTP server
+
+Runs the same pipeline as /encrypt and /decrypt on a process pool and
+appends one JSON line per video to a report:
+
+    python bulk.py encode archive/ --text "TruthCast" --output-dir stamped/ --report encode.jsonl
+    python bulk.py verify stamped/ --expect "TruthCast" --report verify.jsonl
+
+The source is a directory, scanned recursively for videos, or a manifest:
+a text file with one path per line, or a .jsonl file of {"path": ..., "text": ...}
+objects for per-video texts. Videos already in the report are skipped, so
+an interrupted run picks up where it stopped (--retry-errors also redoes
+failed ones). Keys, caches and scratch folders are those of --workdir,
+the server directory by default, so the results match the server's.
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.m4v', '.mkv', '.webm', '.avi')
+
+server = None  # imported in every worker process, and by main to check --formats
+
+
+def _import_server(workdir):
+    """Import the server inside the working directory, where it keeps its keys and caches"""
+    global server
+    os.chdir(workdir)
+    if SERVER_DIR not in sys.path:
+        sys.path.insert(0, SERVER_DIR)
+    import server as server_module
+    server = server_module
+
+
+def _init_worker(workdir, verbose):
+    """Import the server in a worker, silencing its log unless verbose"""
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+    _import_server(workdir)
+
+
+def text_digest(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def encode_item(item, options):
+    """Hide the item's text in it, writing the outputs below the output directory"""
+    relative = os.path.splitext(item["relative"])[0]
+    output_dir = os.path.join(options["output_dir"], os.path.dirname(relative))
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, f"encoded_{os.path.basename(relative)}")
+    output_paths, stats = server.encrypt_video_file(item["path"], item["text"], output_path, options["workers"],
+                                                    options["formats"], mode=options["mode"])
+    return {"status": "ok", "outputs": output_paths, "payload_sha256": text_digest(item["text"]), **stats}
+
+
+def verify_item(item, options):
+    """Decode the item and report the hash of what it holds"""
+    # The stages of decrypt_video_file, whose result cannot tell a decrypted
+    # payload from border data or from an error message
+    with contextlib.closing(server.plan_decode(item["path"])) as plan:
+        with server.span('border_sampling'):
+            border_data = server.extract_border_data(item["path"], plan)
+        with server.span('lsb_reveal'):
+            payload, _ = server.reveal_payload(plan)
+
+    # Lossy outputs only keep the border copy of the text
+    source = 'lsb'
+    if payload is None:
+        if not border_data.startswith('STEGO:'):
+            return {"status": "not_found"}
+        payload, source = border_data[len('STEGO:'):], 'border'
+    expected = item.get("text") or options["expect"]
+    status = 'ok'
+    if expected is not None and payload != expected:
+        status = 'mismatch'
+    return {"status": status, "source": source, "payload_sha256": text_digest(payload)}
+
+
+def process(command, item, options):
+    """Run one item in a worker, returning its report line"""
+    line = {"command": command, "path": item["path"]}
+    timer = server.start_timer()
+    start = time.perf_counter()
+    try:
+        line.update(encode_item(item, options) if command == 'encode' else verify_item(item, options))
+    except Exception as e:
+        line.update(status='error', error=f"{type(e).__name__}: {e}")
+    line["seconds"] = round(time.perf_counter() - start, 3)
+    line["stages"] = {stage: round(seconds, 3) for stage, seconds in timer.totals.items()}
+    return line
+
+
+def load_items(source):
+    """List the videos of a directory or manifest as {"path", "relative", "text"} items"""
+    source = os.path.abspath(source)
+    if os.path.isdir(source):
+        items = []
+        for directory, subdirectories, files in os.walk(source):
+            subdirectories.sort()
+            for name in sorted(files):
+                if name.lower().endswith(VIDEO_EXTENSIONS):
+                    path = os.path.join(directory, name)
+                    items.append({"path": path, "relative": os.path.relpath(path, source), "text": None})
+        return items
+
+    base = os.path.dirname(source)
+    items = []
+    with open(source) as manifest:
+        for line in manifest:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            entry = json.loads(line) if source.endswith('.jsonl') else {"path": line}
+            path = os.path.normpath(os.path.join(base, entry["path"]))
+            relative = os.path.relpath(path, base)
+            if relative.startswith('..'):
+                relative = os.path.basename(path)
+            items.append({"path": path, "relative": relative, "text": entry.get("text")})
+    return items
+
+
+def load_report(report_path, command, retry_errors):
+    """Paths the report already covers for this command"""
+    done = set()
+    if not os.path.exists(report_path):
+        return done
+    with open(report_path) as report:
+        for line in report:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # A line cut short by an interrupted run
+            if entry.get("command") != command:
+                continue
+            if retry_errors and entry.get("status") == 'error':
+                done.discard(entry["path"])
+            else:
+                done.add(entry["path"])
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=['encode', 'verify'])
+    parser.add_argument('source', help='directory of videos or manifest file')
+    parser.add_argument('--report', required=True, help='JSONL report, appended to and used to resume')
+    parser.add_argument('--text', help='text to hide in every video (encode), unless the manifest has one')
+    parser.add_argument('--expect', help='text every video should hold (verify)')
+    parser.add_argument('--output-dir', help='where encoded videos go, mirroring the source layout (encode)')
+    parser.add_argument('--formats', default='mp4', help='comma separated output formats (encode)')
+    parser.add_argument('--mode', default='full', choices=['full', 'sparse'], help='encode mode (encode)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='videos processed in parallel')
+    parser.add_argument('--frame-workers', type=int, default=1, help='frame workers per video (encode)')
+    parser.add_argument('--workdir', default=SERVER_DIR, help='directory holding the keys and caches')
+    parser.add_argument('--retry-errors', action='store_true', help='process videos that failed before again')
+    parser.add_argument('--verbose', action='store_true', help='show the pipeline log')
+    args = parser.parse_args()
+
+    items = load_items(args.source)
+    if args.command == 'encode':
+        if args.output_dir is None:
+            parser.error("encode needs --output-dir")
+        missing = [item["path"] for item in items if item["text"] is None and args.text is None]
+        if missing:
+            parser.error(f"no text for {len(missing)} videos, pass --text")
+        for item in items:
+            item["text"] = item["text"] if item["text"] is not None else args.text
+
+    formats = [fmt.strip().lower() for fmt in args.formats.split(',') if fmt.strip()]
+    if args.mode == 'sparse' and formats != ['mp4']:
+        parser.error("sparse mode only produces mp4")
+    # Relative paths are resolved before the server import changes the directory
+    output_dir = os.path.abspath(args.output_dir) if args.output_dir else None
+    report_path = os.path.abspath(args.report)
+    workdir = os.path.abspath(args.workdir)
+    if args.command == 'encode':
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+            _import_server(workdir)
+        unknown = [fmt for fmt in formats if fmt not in server.OUTPUT_PROFILES]
+        if unknown or not formats:
+            parser.error(f"unknown format {', '.join(unknown) or repr(args.formats)}, "
+                         f"choose from {', '.join(server.OUTPUT_PROFILES)}")
+
+    options = {
+        "output_dir": output_dir,
+        "formats": formats,
+        "mode": args.mode,
+        "workers": max(1, args.frame_workers),
+        "expect": args.expect,
+    }
+    done = load_report(report_path, args.command, args.retry_errors)
+    pending = [item for item in items if item["path"] not in done]
+    print(f"{len(items)} videos, {len(items) - len(pending)} already in the report, {len(pending)} to {args.command}")
+
+    counts = {}
+    with open(report_path, 'a') as report, \
+            ProcessPoolExecutor(max(1, args.jobs), initializer=_init_worker,
+                                initargs=(workdir, args.verbose)) as pool:
+        futures = {pool.submit(process, args.command, item, options): item for item in pending}
+        for finished, future in enumerate(as_completed(futures), 1):
+            try:
+                line = future.result()
+            except Exception as e:
+                # The worker process itself died
+                line = {"command": args.command, "path": futures[future]["path"],
+                        "status": 'error', "error": f"{type(e).__name__}: {e}"}
+            report.write(json.dumps(line) + '\n')
+            report.flush()
+            counts[line["status"]] = counts.get(line["status"], 0) + 1
+            print(f"[{finished}/{len(pending)}] {line['status']:<9} {line.get('seconds', 0):8.2f} s  {line['path']}")
+
+    print(', '.join(f"{count} {status}" for status, count in sorted(counts.items())) or 'Nothing to do')
+    if counts.get('error') or counts.get('mismatch'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+"""gunicorn settings for the steganography server
+
+Every value can be overridden from the environment. Each worker admits at
+most MAX_CONCURRENT_WORK encodes/decodes at once (see server.py), the
+remaining threads keep answering health checks and 429s while it is busy.
+Workers write their metrics to METRICS_FOLDER so /metrics covers all of them.
+"""
+import multiprocessing
+import os
+import shutil
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', max(1, multiprocessing.cpu_count() // 2)))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# Load the app, keys included, in the master before forking
+preload_app = True
+
+# Metrics shared by the workers, read by server.py when it is imported
+os.environ.setdefault('METRICS_FOLDER', './metrics')
+
+# Encoding long uploads takes a while
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 600))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 60))
+keepalive = 5
+
+# Recycle workers now and then to bound memory growth
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 500))
+max_requests_jitter = 50
+
+accesslog = '-'
+errorlog = '-'
+
+
+def on_starting(server):
+    """Start counting from zero, like a single process would after a restart"""
+    shutil.rmtree(os.environ['METRICS_FOLDER'], ignore_errors=True)
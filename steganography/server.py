@@ -1,4 +1,4 @@
-from flask import Flask, request, send_file, jsonify
+from flask import Flask, Response, request, send_file, jsonify
 import os
 import cv2
 import math
@@ -7,15 +7,39 @@ import base64
 import numpy as np
 import colorsys
 import uuid
-from stegano import lsb
+import functools
+import contextlib
+import atexit
+import bisect
+import hashlib
+import zlib
+import json
+import sys
+import time
 from cryptography.hazmat.primitives.asymmetric import rsa, padding as rsa_padding
 from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from werkzeug.utils import secure_filename
 from flask_cors import CORS
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import subprocess
+import struct
+import mimetypes
+import zipfile
+import io
+import queue
+import threading
+import collections
+import multiprocessing
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
 from werkzeug.datastructures import FileStorage
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NEED_DATA
 from io import BytesIO
+try:
+    import fcntl
+except ImportError:  # Windows, where the workspace quota is kept per process
+    fcntl = None
 
 
 app = Flask(__name__)
@@ -31,48 +55,486 @@ def after_request(response):
 
 # Configure upload settings
 UPLOAD_FOLDER = './uploads'
-TEMP_FOLDER = './tmp'
+TEMP_FOLDER = os.environ.get('TEMP_FOLDER', './tmp')  # request scratch space, e.g. /dev/shm/truthcast for tmpfs
 KEYS_FOLDER = './keys'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(TEMP_FOLDER, exist_ok=True)
 os.makedirs(KEYS_FOLDER, exist_ok=True)
 
-def convert_to_mp4(mov_path, output_dir):
-    """Convert MOV file to MP4 using ffmpeg"""
-    # Create the output path with .mp4 extension
-    mp4_path = mov_path.rsplit('.', 1)[0] + '.mp4'
+# Maximum number of decoded frames held between the reader and the
+# processing stages, so memory stays bounded on long uploads
+FRAME_WINDOW = int(os.environ.get('FRAME_WINDOW', 8))
+
+# Workers used for the per-frame stages (border, LSB) of one request, and
+# the upper bound a request may ask for. "thread" suits these stages since
+# OpenCV and NumPy release the GIL, "process" moves them to a process pool
+# fed through shared memory
+FRAME_WORKERS = int(os.environ.get('FRAME_WORKERS', 1))
+MAX_FRAME_WORKERS = int(os.environ.get('MAX_FRAME_WORKERS', os.cpu_count() or 1))
+FRAME_EXECUTOR = os.environ.get('FRAME_EXECUTOR', 'thread')
+
+# Size of the chunks binary responses are streamed in
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# Gaps between wanted frames longer than this are crossed with a seek
+# instead of decoding every frame in between, for videos without a keyframe index
+SEEK_DISTANCE = int(os.environ.get('SEEK_DISTANCE', 250))
+
+# With a keyframe index, a wanted frame is seeked to when the keyframe before
+# it saves decoding more than this many frames
+KEYFRAME_SEEK_COST = int(os.environ.get('KEYFRAME_SEEK_COST', 30))
+FFPROBE_BINARY = os.environ.get('FFPROBE_BINARY', 'ffprobe')
+
+# Frames /decrypt looks at: frame 0 with the payload header, and border
+# samples, keyframes first, read until they agree. Videos from before the header keep their metadata
+# frame in the tail, or their payload in the first frames
+BORDER_SAMPLES = 10  # most frames read for border data
+BORDER_AGREE_FRAMES = int(os.environ.get('BORDER_AGREE_FRAMES', 2))  # frames decoding alike that settle the border data
+BORDER_CONFIDENCE = float(os.environ.get('BORDER_CONFIDENCE', 0.9))  # mean vote margin that settles it sooner
+BORDER_COLOR_TOLERANCE = 80  # BGR distance from the bit colours' blends within which a pixel counts as a bit
+METADATA_PROBE_FRAMES = 5
+LSB_FALLBACK_FRAMES = 15
+
+# Metrics
+# Counters and histograms live in process memory and are served in the
+# Prometheus text format by /metrics. With METRICS_FOLDER set (gunicorn.conf.py
+# does) every worker process also writes its values there and /metrics adds
+# up the files of all workers. Stage timings come from spans around
+# each pipeline stage; the time of a span excludes the spans nested in it, so
+# interleaved streaming stages are still told apart
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+METRICS = []
+METRICS_FOLDER = os.environ.get('METRICS_FOLDER')  # shared by the worker processes, unset for a single process
+METRICS_FLUSH_INTERVAL = 1.0  # seconds a worker's file may lag behind its counts
+
+class Counter:
+    """Monotonic counter with optional labels"""
+    
+    kind = 'counter'
+    
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        metric_files.changed()
+    
+    def values(self):
+        """Copy of this process's values by label values"""
+        with self._lock:
+            return dict(self._values)
+    
+    @staticmethod
+    def add(value, other):
+        return value + other
+    
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.label_names, key)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+    
+    def render(self, values):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{self.name}{self._labels(key)} {value}" for key, value in sorted(values.items()))
+        return lines
+
+class Histogram(Counter):
+    """Distribution of observed values over METRIC_BUCKETS"""
+    
+    kind = 'histogram'
+    
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(METRIC_BUCKETS), 0.0, 0))
+            bucket = bisect.bisect_left(METRIC_BUCKETS, value)
+            if bucket < len(counts):
+                counts[bucket] += 1
+            self._values[key] = (counts, total + value, count + 1)
+        metric_files.changed()
+    
+    def values(self):
+        with self._lock:
+            return {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+    
+    @staticmethod
+    def add(value, other):
+        return [a + b for a, b in zip(value[0], other[0])], value[1] + other[1], value[2] + other[2]
+    
+    def render(self, values):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(METRIC_BUCKETS, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{self._labels(key, [('le', str(bound))])} {cumulative}")
+            lines.append(f"{self.name}_bucket{self._labels(key, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {total}")
+            lines.append(f"{self.name}_count{self._labels(key)} {count}")
+        return lines
+
+class MetricFiles:
+    """Shares the metric values of every process through one file per process
+    
+    Each process rewrites <pid>.json in the folder at most every
+    METRICS_FLUSH_INTERVAL after its values change, and a scrape adds up the
+    files. Files of processes that exited, like workers gunicorn recycled,
+    are folded into exited.json so their counts never go backwards.
+    """
+    
+    def __init__(self, folder):
+        self.folder = folder
+        self._pid = None
+        self._start_lock = threading.Lock()
+    
+    def changed(self):
+        """Note that this process's values changed"""
+        if self.folder is None:
+            return
+        if self._pid != os.getpid():
+            self._start()
+        self._dirty.set()
+    
+    def _start(self):
+        """Start the flush thread, once in every (forked) process"""
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._dirty = threading.Event()
+            self._flush_lock = threading.Lock()
+            self._pid = os.getpid()
+        threading.Thread(target=self._flush_worker, name='metrics-flush', daemon=True).start()
+        atexit.register(self.flush)
+    
+    def _flush_worker(self):
+        while True:
+            self._dirty.wait()
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            self._dirty.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"[WARNING] Could not write metrics: {e}")
+    
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the lock that keeps two scrapes from folding the same file"""
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.folder, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    @staticmethod
+    def _read(path):
+        with open(path) as f:
+            values = json.load(f)
+        return {name: {tuple(key): value for key, value in pairs} for name, pairs in values.items()}
+    
+    @staticmethod
+    def _write(path, values):
+        with open(path + '.tmp', 'w') as f:
+            json.dump({name: [[list(key), value] for key, value in merged.items()] for name, merged in values.items()}, f)
+        os.replace(path + '.tmp', path)
+    
+    @staticmethod
+    def _merge(totals, values):
+        """Add values, by metric name then label values, to totals"""
+        for metric in METRICS:
+            merged = totals.setdefault(metric.name, {})
+            for key, value in values.get(metric.name, {}).items():
+                merged[key] = metric.add(merged[key], value) if key in merged else value
+    
+    def flush(self):
+        """Write this process's values to its file"""
+        if self._pid != os.getpid():
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        with self._flush_lock:
+            self._write(os.path.join(self.folder, f'{self._pid}.json'),
+                        {metric.name: metric.values() for metric in METRICS})
+    
+    def collect(self):
+        """Values of every process by metric name, then label values"""
+        if self.folder is None:
+            return {metric.name: metric.values() for metric in METRICS}
+        self.flush()
+        os.makedirs(self.folder, exist_ok=True)
+        totals = {}
+        with self._locked():
+            exited_path = os.path.join(self.folder, 'exited.json')
+            exited = self._read(exited_path) if os.path.exists(exited_path) else {}
+            folded = []
+            for entry in os.scandir(self.folder):
+                pid = entry.name[:-len('.json')]
+                if not entry.name.endswith('.json') or not pid.isdigit():
+                    continue
+                try:
+                    os.kill(int(pid), 0)
+                    alive = True
+                except ProcessLookupError:
+                    alive = False
+                except PermissionError:
+                    alive = True  # Someone else's process
+                try:
+                    self._merge(totals if alive else exited, self._read(entry.path))
+                except (OSError, ValueError):
+                    continue  # Removed meanwhile
+                if not alive:
+                    folded.append(entry.path)
+            if folded:
+                self._write(exited_path, exited)
+                for path in folded:
+                    os.remove(path)
+        self._merge(totals, exited)
+        return totals
+
+metric_files = MetricFiles(METRICS_FOLDER)
+
+REQUESTS = Counter('truthcast_requests_total', 'HTTP requests handled', ('endpoint', 'status'))
+REQUEST_SECONDS = Histogram('truthcast_request_duration_seconds', 'Time to produce a response', ('endpoint',))
+STAGE_SECONDS = Histogram('truthcast_stage_duration_seconds', 'Time spent in each pipeline stage per request or job', ('stage',))
+STAGE_FAILURES = Counter('truthcast_stage_failures_total', 'Requests and jobs that failed, by the stage that raised', ('stage',))
+FRAMES_PROCESSED = Counter('truthcast_frames_processed_total', 'Frames encoded or read for decoding', ('pipeline',))
+BYTES_IN = Counter('truthcast_bytes_in_total', 'Request body bytes received', ('endpoint',))
+BYTES_OUT = Counter('truthcast_bytes_out_total', 'Response body bytes sent', ('endpoint',))
+CACHE_LOOKUPS = Counter('truthcast_cache_lookups_total', 'Result cache lookups', ('cache', 'result'))
+
+class StageTimer:
+    """Adds up the time a request or job spends in each stage"""
     
-    try:
-        # Use ffmpeg to convert from MOV to MP4
-        # -c:v libx264 uses H.264 codec for video
-        # -crf 23 is a good balance between quality and file size
-        # -preset fast provides a good encoding speed
-        # -c:a aac uses AAC codec for audio
-        # -b:a 128k sets audio bitrate
+    def __init__(self):
+        self.totals = {}
+        self._nested = []  # time taken by child spans of each open span
+    
+    @contextlib.contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        self._nested.append(0.0)
+        try:
+            yield
+        except Exception as e:
+            # Count the failure once, against the innermost stage
+            if not getattr(e, 'failed_stage', None):
+                e.failed_stage = stage
+                STAGE_FAILURES.inc(stage=stage)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self._nested.pop()
+            self.totals[stage] = self.totals.get(stage, 0.0) + elapsed - nested
+            if self._nested:
+                self._nested[-1] += elapsed
+    
+    def observe(self):
+        """Feed the stage totals into the stage histogram"""
+        for stage, seconds in self.totals.items():
+            STAGE_SECONDS.observe(seconds, stage=stage)
+    
+    def merge(self, other):
+        """Add the totals of a timer that ran on a helper thread"""
+        for stage, seconds in other.totals.items():
+            self.totals[stage] = self.totals.get(stage, 0.0) + seconds
+    
+    def server_timing(self):
+        return ', '.join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.totals.items())
+
+_timers = threading.local()
+
+def current_timer():
+    """StageTimer of the request or job running on this thread"""
+    timer = getattr(_timers, 'timer', None)
+    if timer is None:
+        timer = _timers.timer = StageTimer()
+    return timer
+
+def start_timer():
+    """Give this thread a fresh StageTimer and return it"""
+    _timers.timer = StageTimer()
+    return _timers.timer
+
+def span(stage):
+    """Time a block as one stage of the current request or job"""
+    return current_timer().span(stage)
+
+def metered(stage, iterable):
+    """Time producing each item of a frame stream as the given stage"""
+    timer = current_timer()
+    iterator = iter(iterable)
+    while True:
+        with timer.span(stage):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+@app.before_request
+def start_request_timer():
+    start_timer()
+    request.environ['truthcast.start'] = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or 'unknown'
+    if endpoint == 'metrics_endpoint':
+        return response
+    timer = current_timer()
+    timer.observe()
+    REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    REQUEST_SECONDS.observe(time.perf_counter() - request.environ['truthcast.start'], endpoint=endpoint)
+    BYTES_IN.inc(request.content_length or 0, endpoint=endpoint)
+    BYTES_OUT.inc(response.content_length or 0, endpoint=endpoint)
+    if timer.totals:
+        response.headers['Server-Timing'] = timer.server_timing()
+        response.headers['Timing-Allow-Origin'] = '*'
+    return response
+
+# ffmpeg executable used for all video encoding
+FFMPEG_BINARY = os.environ.get('FFMPEG_BINARY', 'ffmpeg')
+
+# Output profiles a request can ask for by name (the "formats" option). Each
+# sets its container, codec arguments and x264 preset. Only the lossless ones
+# keep the LSB payload; the lossy ones keep the border data.
+# benchmarks/profiles.py measures them
+OUTPUT_PROFILES = {
+    # PNG codec in MOV keeps every pixel, and with it the LSB payload
+    'mov': {'extension': 'mov', 'args': ['-c:v', 'png'], 'preset': None},
+    # H.264 for playback, lossy so only the border data survives
+    # -crf 23 is a good balance between quality and file size
+    # -preset fast provides a good encoding speed
+    'mp4': {'extension': 'mp4', 'args': ['-c:v', 'libx264', '-crf', '23'], 'preset': 'fast'},
+    # Lossless H.264 straight from the BGR frames; plain libx264 would round through YUV
+    'lossless': {'extension': 'mp4', 'args': ['-c:v', 'libx264rgb', '-qp', '0'], 'preset': 'veryfast'},
+    # Lossless intra-only FFV1 in Matroska, quick to write and to seek
+    'ffv1': {'extension': 'mkv', 'args': ['-c:v', 'ffv1', '-level', '3', '-g', '1', '-slices', '4'],
+             'preset': None},
+    # Lossy H.264 when turnaround matters more than size
+    'fast': {'extension': 'mp4', 'args': ['-c:v', 'libx264', '-crf', '26'], 'preset': 'ultrafast'},
+    # Lossy H.264 close to transparent, for keeping
+    'archival': {'extension': 'mp4', 'args': ['-c:v', 'libx264', '-crf', '16'], 'preset': 'slow'},
+}
+
+def output_args(profile):
+    """ffmpeg encoder arguments of an output profile"""
+    settings = OUTPUT_PROFILES[profile]
+    args = list(settings['args'])
+    if settings['preset']:
+        args += ['-preset', settings['preset']]
+    return args
+
+def output_suffix(profile):
+    """File name ending of an output profile, e.g. .mp4 for mp4 and _lossless.mp4 for lossless"""
+    extension = OUTPUT_PROFILES[profile]['extension']
+    return f".{extension}" if profile == extension else f"_{profile}.{extension}"
+
+class FFmpegError(RuntimeError):
+    """ffmpeg failed; the message carries the end of its stderr"""
+
+class FFmpegWriter:
+    """Stream raw BGR frames into one ffmpeg process that writes every requested output
+    
+    outputs is a list of (path, encoder_args), each encoded from the same input.
+    """
+    
+    def __init__(self, outputs, width, height, fps):
+        self.width = width
+        self.height = height
         command = [
-            'ffmpeg',
-            '-i', mov_path,
-            '-c:v', 'libx264',
-            '-crf', '23',
-            '-preset', 'fast',
-            '-c:a', 'aac',
-            '-b:a', '128k',
-            mp4_path
+            FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-y',
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+            '-s', f'{width}x{height}', '-framerate', str(fps),
+            '-i', 'pipe:0',
         ]
         
-        # Execute the command
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
+        for path, args in outputs:
+            command += ['-map', '0:v'] + list(args) + [path]
         
-        if process.returncode != 0:
-            print(f"Error converting video: {stderr.decode()}")
-            return None
+        try:
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except OSError as e:
+            raise FFmpegError(f"Could not start ffmpeg: {e}") from e
         
-        print(f"Successfully converted {mov_path} to {mp4_path}")
-        return mp4_path
-    except Exception as e:
-        print(f"Error during conversion: {str(e)}")
-        return None
+        # Drain stderr on a thread so a chatty ffmpeg can never block the pipe
+        self._stderr = []
+        self._stderr_thread = threading.Thread(target=self._read_stderr, daemon=True)
+        self._stderr_thread.start()
+    
+    def _read_stderr(self):
+        for line in self.process.stderr:
+            self._stderr.append(line)
+            del self._stderr[:-50]
+    
+    def _error(self, message):
+        self._stderr_thread.join(timeout=5)
+        details = b''.join(self._stderr).decode(errors='replace').strip()
+        return FFmpegError(f"{message}: {details}" if details else message)
+    
+    def write(self, frame):
+        if frame.shape[:2] != (self.height, self.width):
+            raise ValueError(f"Frame size {frame.shape[1]}x{frame.shape[0]} does not match "
+                             f"output size {self.width}x{self.height}")
+        try:
+            self.process.stdin.write(np.ascontiguousarray(frame).data)
+        except (BrokenPipeError, ValueError):
+            self.process.wait()
+            raise self._error(f"ffmpeg exited with code {self.process.returncode}")
+    
+    def close(self):
+        """Finish the outputs, raising FFmpegError if ffmpeg failed"""
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = self.process.wait()
+        if returncode != 0:
+            raise self._error(f"ffmpeg exited with code {returncode}")
+    
+    def abort(self):
+        self.process.kill()
+        self.process.wait()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def convert_to_mp4(mov_path, output_dir):
+    """Convert MOV file to MP4 using ffmpeg"""
+    # Create the output path with .mp4 extension
+    mp4_path = mov_path.rsplit('.', 1)[0] + '.mp4'
+    
+    # Use ffmpeg to convert from MOV to MP4
+    # -c:a aac uses AAC codec for audio
+    # -b:a 128k sets audio bitrate
+    command = [FFMPEG_BINARY, '-y', '-i', mov_path] + output_args('mp4') + ['-c:a', 'aac', '-b:a', '128k', mp4_path]
+    
+    # Execute the command
+    with span('ffmpeg'):
+        process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise FFmpegError(f"Error converting video: {process.stderr.decode(errors='replace').strip()}")
+    
+    print(f"Successfully converted {mov_path} to {mp4_path}")
+    return mp4_path
 
 # RSA encryption and decryption functions
 def generate_keys(key_size=2048):
@@ -114,233 +576,1291 @@ def generate_keys(key_size=2048):
     
     print(f"Public and Private keys created with size {key_size}")
 
+# Key ring
+# Keys are parsed once per process and only reloaded when the files in
+# KEYS_FOLDER change. Every key is known by a short ID, the first bytes of the
+# SHA-256 of its public key, which encrypted payloads carry so decryption can
+# pick the right key directly, and older keys stay usable after a rotation
+KEY_SIZE = 2048
+KEY_ID_SIZE = 4
+KEY_RELOAD_INTERVAL = float(os.environ.get('KEY_RELOAD_INTERVAL', 5))  # seconds between mtime checks
+ACTIVE_KEY_FILE = 'active_key'  # holds the ID of the key new payloads are encrypted with
+KEYED_PAYLOAD_VERSION = b'\x01'
+
+OAEP_PADDING = rsa_padding.OAEP(
+    mgf=rsa_padding.MGF1(algorithm=hashes.SHA256()),
+    algorithm=hashes.SHA256(),
+    label=None
+)
+
+def key_id(public_key):
+    """Short identifier of an RSA public key"""
+    der = public_key.public_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    return hashlib.sha256(der).digest()[:KEY_ID_SIZE]
+
+class KeyRing:
+    """Private keys of KEYS_FOLDER, indexed by key ID"""
+    
+    def __init__(self, folder):
+        self.folder = folder
+        self.keys = {}
+        self.active_id = None
+        self.legacy_id = None  # key of the original private_key_<size>.pem, used for payloads without an ID
+        self.generation = 0  # bumped whenever the loaded keys change
+        self.fingerprint = None  # identifies the set of loaded keys across restarts
+        self._signature = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+    
+    def _key_files(self):
+        return sorted(name for name in os.listdir(self.folder)
+                      if name.startswith('private_key_') and name.endswith('.pem'))
+    
+    def _current_signature(self):
+        signature = []
+        for name in self._key_files() + [ACTIVE_KEY_FILE]:
+            try:
+                signature.append((name, os.stat(os.path.join(self.folder, name)).st_mtime_ns))
+            except FileNotFoundError:
+                pass
+        return tuple(signature)
+    
+    def refresh(self, force=False):
+        """Reload the keys if the key files changed since the last check"""
+        now = time.monotonic()
+        if not force and self._signature is not None and now - self._checked_at < KEY_RELOAD_INTERVAL:
+            return
+        with self._lock:
+            self._checked_at = now
+            signature = self._current_signature()
+            if signature == self._signature:
+                return
+            if not any(name != ACTIVE_KEY_FILE for name, _ in signature):
+                generate_keys(KEY_SIZE)
+                signature = self._current_signature()
+            self._load()
+            self._signature = signature
+    
+    def _load(self):
+        keys = {}
+        legacy_id = None
+        for name in self._key_files():
+            with open(os.path.join(self.folder, name), 'rb') as key_file:
+                private_key = serialization.load_pem_private_key(key_file.read(), password=None)
+            kid = key_id(private_key.public_key())
+            keys[kid] = private_key
+            if name == f'private_key_{KEY_SIZE}.pem':
+                legacy_id = kid
+        
+        active_id = legacy_id
+        marker = os.path.join(self.folder, ACTIVE_KEY_FILE)
+        if os.path.isfile(marker):
+            with open(marker) as marker_file:
+                active_id = bytes.fromhex(marker_file.read().strip())
+        if active_id not in keys:
+            active_id = next(iter(keys))
+        
+        self.keys, self.active_id, self.legacy_id = keys, active_id, legacy_id
+        self.fingerprint = hashlib.sha256(b''.join(sorted(keys))).hexdigest()[:16]
+        self.generation += 1
+        print(f"[INFO] Loaded {len(keys)} RSA keys, active key {active_id.hex()}")
+    
+    def active(self):
+        """Return (key ID, private key) used for new payloads"""
+        self.refresh()
+        return self.active_id, self.keys[self.active_id]
+    
+    def get(self, kid):
+        """Return the private key with the given ID, or None"""
+        self.refresh()
+        return self.keys.get(kid)
+
+keyring = KeyRing(KEYS_FOLDER)
+
+def rotate_keys(key_size=KEY_SIZE):
+    """Create a new key pair and make it the active key; older keys still decrypt"""
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+    kid = key_id(private_key.public_key()).hex()
+    
+    with open(os.path.join(KEYS_FOLDER, f'private_key_{kid}.pem'), 'wb') as file_obj:
+        file_obj.write(private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        ))
+    with open(os.path.join(KEYS_FOLDER, f'public_key_{kid}.pem'), 'wb') as file_obj:
+        file_obj.write(private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        ))
+    
+    # Write the marker last so the key is complete before it becomes active
+    marker = os.path.join(KEYS_FOLDER, ACTIVE_KEY_FILE)
+    with open(marker + '.tmp', 'w') as marker_file:
+        marker_file.write(kid)
+    os.replace(marker + '.tmp', marker)
+    
+    keyring.refresh(force=True)
+    print(f"Rotated to new key {kid}")
+    return kid
+
+# Envelope encryption
+# A random AES-256-GCM key encrypts the message and a single RSA-OAEP
+# operation wraps that key, so messages of any length cost one RSA call.
+# Layout: magic, key ID, wrapped key length, wrapped key, nonce, ciphertext + tag.
+# The magic starts with a byte base64 never produces, which tells envelopes
+# apart from the older base64 payloads
+ENVELOPE_MAGIC = b'\x00TE\x01'
+ENVELOPE_HEADER = struct.Struct(f'>4s{KEY_ID_SIZE}sH')
+ENVELOPE_NONCE_SIZE = 12
+
 def encrypt_rsa(message):
-    """Encrypt message using RSA"""
-    key_size = 2048
-    # Ensure keys exist
-    generate_keys(key_size)
+    """Encrypt message into an AES-GCM envelope whose key is wrapped with RSA
     
-    # Read public key
-    public_key_path = os.path.join(KEYS_FOLDER, f'public_key_{key_size}.pem')
-    with open(public_key_path, 'rb') as key_file:
-        public_key = serialization.load_pem_public_key(key_file.read())
+    Returns the binary envelope.
+    """
+    kid, private_key = keyring.active()
     
-    # Encrypt the message
+    # Encrypt the message with a fresh data key
     message_bytes = message.encode('utf-8') if isinstance(message, str) else message
-    ciphertext = public_key.encrypt(
-        message_bytes,
-        rsa_padding.OAEP(
-            mgf=rsa_padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
-        )
-    )
+    data_key = AESGCM.generate_key(bit_length=256)
+    nonce = os.urandom(ENVELOPE_NONCE_SIZE)
+    header_prefix = ENVELOPE_MAGIC + kid
+    ciphertext = AESGCM(data_key).encrypt(nonce, message_bytes, header_prefix)
     
-    # Encode in base64
-    return base64.b64encode(ciphertext)
+    # Wrap the data key with the RSA public key
+    wrapped_key = private_key.public_key().encrypt(data_key, OAEP_PADDING)
+    
+    return ENVELOPE_HEADER.pack(ENVELOPE_MAGIC, kid, len(wrapped_key)) + wrapped_key + nonce + ciphertext
+
+def _decrypt_envelope(envelope):
+    """Open a binary envelope made by encrypt_rsa"""
+    if len(envelope) < ENVELOPE_HEADER.size:
+        raise ValueError("Truncated envelope")
+    magic, kid, wrapped_size = ENVELOPE_HEADER.unpack_from(envelope)
+    private_key = keyring.get(kid)
+    if private_key is None:
+        raise ValueError(f"Unknown key {kid.hex()}")
+    
+    offset = ENVELOPE_HEADER.size
+    wrapped_key = envelope[offset:offset + wrapped_size]
+    offset += wrapped_size
+    nonce = envelope[offset:offset + ENVELOPE_NONCE_SIZE]
+    ciphertext = envelope[offset + ENVELOPE_NONCE_SIZE:]
+    
+    data_key = private_key.decrypt(wrapped_key, OAEP_PADDING)
+    return AESGCM(data_key).decrypt(nonce, ciphertext, magic + kid)
 
 def decrypt_rsa(encoded_message):
-    """Decrypt message using RSA"""
-    key_size = 2048
-    # Ensure keys exist
-    generate_keys(key_size)
-    
-    # Set private key path
-    private_key_path = os.path.join(KEYS_FOLDER, f'private_key_{key_size}.pem')
-    
-    # Read private key
-    with open(private_key_path, 'rb') as key_file:
-        private_key = serialization.load_pem_private_key(
-            key_file.read(),
-            password=None
-        )
-    
-    # Decode base64 if needed
+    """Decrypt a message made by encrypt_rsa
+    
+    Besides envelopes this accepts the older base64 payloads: RSA ciphertext
+    with a key ID, and bare ciphertexts which were always made with the
+    original key.
+    """
     if isinstance(encoded_message, str):
         encoded_message = encoded_message.encode('utf-8')
     
+    keyring.refresh()
+    if encoded_message.startswith(ENVELOPE_MAGIC):
+        return _decrypt_envelope(encoded_message)
+    
     cipher_text = base64.b64decode(encoded_message)
+    if len(cipher_text) == KEY_SIZE // 8:
+        private_key = keyring.get(keyring.legacy_id) if keyring.legacy_id else None
+    elif cipher_text[:1] == KEYED_PAYLOAD_VERSION:
+        kid = cipher_text[1:1 + KEY_ID_SIZE]
+        cipher_text = cipher_text[1 + KEY_ID_SIZE:]
+        private_key = keyring.get(kid)
+        if private_key is None:
+            raise ValueError(f"Unknown key {kid.hex()}")
+    else:
+        raise ValueError("Unrecognised payload format")
+    if private_key is None:
+        raise ValueError("No key available for legacy payload")
     
     # Decrypt the message
-    plain_text = private_key.decrypt(
-        cipher_text,
-        rsa_padding.OAEP(
-            mgf=rsa_padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
-        )
-    )
-    
-    return plain_text
+    return private_key.decrypt(cipher_text, OAEP_PADDING)
+
+def payload_key_id(payload):
+    """Key ID an encrypted payload was made with, zeros for formats without one"""
+    if payload.startswith(ENVELOPE_MAGIC) and len(payload) >= ENVELOPE_HEADER.size:
+        return ENVELOPE_HEADER.unpack_from(payload)[1]
+    return bytes(KEY_ID_SIZE)
 
 # Video processing functions
 def split_string(s_str, count=10):
-    """Split string into parts"""
+    """Split string (or bytes) into parts"""
+    if not s_str:
+        return []
     per_c = math.ceil(len(s_str)/count)
-    c_cout = 0
-    out_str = ''
-    split_list = []
-    for s in s_str:
-        out_str += s
-        c_cout += 1
-        if c_cout == per_c:
-            split_list.append(out_str)
-            out_str = ''
-            c_cout = 0
-    if c_cout != 0:
-        split_list.append(out_str)
-    return split_list
-
-def extract_frames(video_path, temp_dir):
-    """Extract frames from video"""
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
+    return [s_str[i:i + per_c] for i in range(0, len(s_str), per_c)]
+
+# LSB steganography on BGR frames
+# Bits are stored in the same order stegano used: pixels row by row, and the
+# R, G, B channels of each pixel, so old payloads can still be located
+LSB_MAGIC = b'TCL'
+LSB_HEADER = struct.Struct('>3sI')  # magic, payload length in bytes
+LSB_COMPAT_MAX_PREFIX = 12  # longest "<length>:" prefix stegano can produce for a frame
+
+def _lsb_positions(start_bit, num_bits):
+    """Indices into a flattened BGR frame for a run of payload bits"""
+    bit_index = np.arange(start_bit, start_bit + num_bits)
+    return (bit_index // 3) * 3 + 2 - bit_index % 3
+
+def _lsb_read_bytes(flat, start_byte, num_bytes):
+    """Read whole bytes from the channel LSBs of a flattened frame"""
+    if (start_byte + num_bytes) * 8 > flat.size:
+        return None
+    bits = flat[_lsb_positions(start_byte * 8, num_bytes * 8)] & 1
+    return np.packbits(bits).tobytes()
+
+def lsb_embed(frame, payload, in_place=False):
+    """Hide a length-prefixed payload in the least significant bits of a frame"""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    data = LSB_HEADER.pack(LSB_MAGIC, len(payload)) + payload
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+    
+    if bits.size > frame.size:
+        raise ValueError(f"The message you want to hide is too long: {len(payload)} bytes")
+    
+    out = frame if in_place else frame.copy()
+    flat = out.reshape(-1)
+    positions = _lsb_positions(0, bits.size)
+    flat[positions] = (flat[positions] & 0xFE) | bits
+    return out
+
+def lsb_extract(frame, compat=True):
+    """Read an LSB payload from a frame, or None if the frame carries none
     
-    print(f"[INFO] Extracting frames from video {video_path}")
-    vidcap = cv2.VideoCapture(video_path)
-    count = 0
-    frames = []
+    With compat set, payloads written by stegano's lsb.hide ("<length>:<message>")
+    are recognised too, so videos published before the built-in codec still decode.
+    Frames without a payload are rejected after reading the first few bytes.
+    """
+    flat = np.ascontiguousarray(frame).reshape(-1)
     
-    while True:
-        success, image = vidcap.read()
-        if not success:
-            break
-        frame_path = os.path.join(temp_dir, f"{count}.png")
-        cv2.imwrite(frame_path, image)
-        frames.append(frame_path)
-        count += 1
+    header = _lsb_read_bytes(flat, 0, LSB_HEADER.size)
+    if header is None:
+        return None
+    magic, length = LSB_HEADER.unpack(header)
+    if magic == LSB_MAGIC:
+        return _lsb_read_bytes(flat, LSB_HEADER.size, length)
     
-    print(f"[INFO] Extracted {count} frames from video")
-    return frames, count
+    if not compat or not header[:1].isdigit():
+        return None
+    
+    prefix = _lsb_read_bytes(flat, 0, LSB_COMPAT_MAX_PREFIX)
+    colon = prefix.find(b':')
+    if colon <= 0 or not prefix[:colon].isdigit():
+        return None
+    return _lsb_read_bytes(flat, colon + 1, int(prefix[:colon]))
+
+# Payload header
+# Frame 0 starts with a header describing where the payload is: magic,
+# version, key ID, payload length, the frames holding its parts and a CRC32
+# of the header. Frame 0's own part follows it, so the layout of a video is
+# known after reading one frame
+PAYLOAD_MAGIC = b'TCPH'
+PAYLOAD_VERSION = 1
+PAYLOAD_HEADER = struct.Struct(f'>4sB{KEY_ID_SIZE}sIH')  # magic, version, key ID, payload length, frame count
+PAYLOAD_INDEX = struct.Struct('>I')
+PAYLOAD_CRC = struct.Struct('>I')
+
+def pack_payload_header(key_id, payload_length, frame_indices):
+    """Build the header written at the start of frame 0"""
+    header = PAYLOAD_HEADER.pack(PAYLOAD_MAGIC, PAYLOAD_VERSION, key_id, payload_length, len(frame_indices))
+    header += b''.join(PAYLOAD_INDEX.pack(i) for i in frame_indices)
+    return header + PAYLOAD_CRC.pack(zlib.crc32(header))
+
+def unpack_payload_header(record):
+    """Parse the header at the start of frame 0's record
+    
+    Returns (key ID, payload length, frame indices, header size), or None if
+    the record does not start with a valid header.
+    """
+    if len(record) < PAYLOAD_HEADER.size or not record.startswith(PAYLOAD_MAGIC):
+        return None
+    magic, version, key_id, payload_length, count = PAYLOAD_HEADER.unpack_from(record)
+    if version != PAYLOAD_VERSION:
+        return None
+    size = PAYLOAD_HEADER.size + count * PAYLOAD_INDEX.size
+    if len(record) < size + PAYLOAD_CRC.size:
+        return None
+    if PAYLOAD_CRC.unpack_from(record, size)[0] != zlib.crc32(record[:size]):
+        return None
+    frame_indices = [PAYLOAD_INDEX.unpack_from(record, PAYLOAD_HEADER.size + i * PAYLOAD_INDEX.size)[0]
+                     for i in range(count)]
+    return key_id, payload_length, frame_indices, size + PAYLOAD_CRC.size
+
+# Parallel per-frame execution
+_frame_pools = {}
+_frame_pools_lock = threading.Lock()
 
-def encode_frames(frames, encrypted_text, temp_dir):
-    """Encode encrypted text into frames"""
-    # Convert to string if it's bytes
-    if isinstance(encrypted_text, bytes):
-        encrypted_text = encrypted_text.decode('utf-8')
+def _frame_pool(mode):
+    """Process-wide pool shared by all requests, sized for MAX_FRAME_WORKERS"""
+    with _frame_pools_lock:
+        pool = _frame_pools.get(mode)
+        if pool is None:
+            if mode == 'process':
+                # Spawned workers do not inherit the server's threads and locks
+                pool = ProcessPoolExecutor(MAX_FRAME_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+            elif mode == 'thread':
+                pool = ThreadPoolExecutor(MAX_FRAME_WORKERS, thread_name_prefix='frame-worker')
+            else:
+                raise ValueError(f"Unknown frame executor: {mode}")
+            _frame_pools[mode] = pool
+        return pool
+
+def _run_in_shared_memory(func, index, name, shape, dtype):
+    """Run func(index, frame) in a worker process on a frame living in shared memory"""
+    # Pool workers share the parent's resource tracker, which unlinks the block
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        frame = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        result = func(index, frame)
+        if result is not frame:
+            frame[...] = result
+        del frame, result
+    finally:
+        shm.close()
+
+def map_frames(func, frames, workers=1, mode=None):
+    """Apply func(index, frame) to a stream of frames, yielding results in input order
+    
+    With more than one worker the calls run on a shared thread or process pool.
+    At most 2 * workers frames are in flight, so memory stays bounded, and the
+    output is the same as a serial run. func may modify the frame in place; in
+    process mode it must be picklable and return a frame of the same shape.
+    """
+    if workers <= 1:
+        for index, frame in enumerate(frames):
+            yield func(index, frame)
+        return
+    
+    mode = mode or FRAME_EXECUTOR
+    pool = _frame_pool(mode)
+    window = workers * 2
+    pending = collections.deque()
+    free_slots = []
+    all_slots = []
+    
+    def submit(index, frame):
+        if mode == 'thread':
+            return pool.submit(func, index, frame), None, None
+        if not free_slots:
+            all_slots.append(shared_memory.SharedMemory(create=True, size=frame.nbytes))
+            free_slots.append(all_slots[-1])
+        slot = free_slots.pop()
+        np.ndarray(frame.shape, dtype=frame.dtype, buffer=slot.buf)[...] = frame
+        future = pool.submit(_run_in_shared_memory, func, index, slot.name, frame.shape, frame.dtype.str)
+        return future, slot, (frame.shape, frame.dtype)
+    
+    def collect(item):
+        future, slot, layout = item
+        result = future.result()
+        if slot is None:
+            return result
+        result = np.ndarray(layout[0], dtype=layout[1], buffer=slot.buf).copy()
+        free_slots.append(slot)
+        return result
+    
+    try:
+        for index, frame in enumerate(frames):
+            if len(pending) >= window:
+                yield collect(pending.popleft())
+            pending.append(submit(index, frame))
+        while pending:
+            yield collect(pending.popleft())
+    finally:
+        for future, _, _ in pending:
+            future.cancel()
+        for future, _, _ in pending:
+            if not future.cancelled():
+                try:
+                    future.result()
+                except Exception:
+                    pass
+        for slot in all_slots:
+            slot.close()
+            slot.unlink()
+
+def read_frames(video_path, window=FRAME_WINDOW):
+    """Yield decoded frames, decoding ahead on a background thread"""
+    frame_queue = queue.Queue(maxsize=window)
+    stop = threading.Event()
+    end_of_stream = object()
+
+    def put(item):
+        # Give up if the consumer went away instead of blocking forever
+        while not stop.is_set():
+            try:
+                frame_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def reader():
+        vidcap = cv2.VideoCapture(video_path)
+        try:
+            while not stop.is_set():
+                success, image = vidcap.read()
+                if not success:
+                    break
+                if not put(image):
+                    return
+            put(end_of_stream)
+        except Exception as e:
+            put(e)
+        finally:
+            vidcap.release()
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = frame_queue.get()
+            if item is end_of_stream:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+def extract_frames(video_path):
+    """Extract frames from video as a stream of BGR arrays"""
+    print(f"[INFO] Extracting frames from video {video_path}")
+
+    # The count is of the stream's packets, callers that need the exact number
+    # of decodable frames have to count the frames they actually receive
+    return read_frames(video_path), video_frame_count(video_path)
+
+def _lsb_stage(parts, frame_num, frame):
+    """Hide the text part belonging to a frame, if it holds one"""
+    if frame_num < len(parts):
+        return lsb_embed(frame, parts[frame_num], in_place=True)
+    return frame
+
+def encode_frames(frames, encrypted_text, workers=1, total_frames=None):
+    """Encode encrypted text into frames, with the payload header in frame 0"""
+    # Work on raw bytes
+    if isinstance(encrypted_text, str):
+        encrypted_text = encrypted_text.encode('utf-8')
         
-    # Split the text into parts
-    split_text_list = split_string(encrypted_text)
+    # Split the text into parts, no more than there are frames
+    count = 10 if total_frames is None else max(1, min(10, total_frames))
+    split_text_list = split_string(encrypted_text, count)
     num_parts = len(split_text_list)
     
-    # Use the first N frames (N = number of text parts)
-    frame_numbers = list(range(min(num_parts, len(frames))))
-    
-    print(f"Encoding text into {len(frame_numbers)} frames")
+    print(f"Encoding text into up to {num_parts} frames")
+    
+    # Hide text parts in the first N frames (N = number of text parts),
+    # frame 0 starts with the header listing them
+    frame_numbers = list(range(num_parts))
+    header = pack_payload_header(payload_key_id(encrypted_text), len(encrypted_text), frame_numbers)
+    stage = functools.partial(_lsb_stage, [header + split_text_list[0]] + split_text_list[1:])
+    encoded = 0
+    for frame_num, frame in enumerate(map_frames(stage, frames, workers)):
+        if frame_num < num_parts:
+            encoded += 1
+            print(f"[INFO] Frame {frame_num} holds {len(split_text_list[frame_num])} bytes")
+        yield frame
+    
+    if encoded == 0:
+        raise ValueError("Video contains no frames")
+    if encoded < num_parts:
+        print(f"[WARNING] Video ended after {encoded} of {num_parts} payload frames")
+
+def create_output_video(frames, original_video, output_path, formats=('mp4',)):
+    """Create output videos from frames in a single ffmpeg pass
     
-    # Hide text parts in frames
-    for i, frame_num in enumerate(frame_numbers):
-        if i >= len(split_text_list):
-            break
-            
-        frame_path = frames[frame_num]
-        # Hide text in frame using LSB steganography
-        secret_enc = lsb.hide(frame_path, split_text_list[i])
-        secret_enc.save(frame_path)
-        print(f"[INFO] Frame {frame_num} holds {split_text_list[i]}")
-    
-    # Save the frame numbers in a special metadata frame
-    # This will help with faster decryption
-    metadata_frame_path = os.path.join(temp_dir, "metadata.png")
-    # Create a simple black image for metadata
-    metadata_img = cv2.imread(frames[0])
-    cv2.imwrite(metadata_frame_path, metadata_img)
-    
-    # Save frame numbers as metadata
-    metadata_content = ",".join(map(str, frame_numbers))
-    metadata_secret = lsb.hide(metadata_frame_path, metadata_content)
-    metadata_secret.save(metadata_frame_path)
-    print(f"[INFO] Metadata frame holds frame numbers: {metadata_content}")
-    
-    # Insert the metadata frame as the last frame to process
-    frames.append(metadata_frame_path)
-        
-    return frame_numbers
-
-def create_output_video(frames, original_video, output_path):
-    """Create output video from frames"""
+    Writes one file per requested format next to output_path and returns
+    {format: path}.
+    """
     # Get video properties
     video = cv2.VideoCapture(original_video)
     fps = video.get(cv2.CAP_PROP_FPS)
     width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    video.release()
     
-    # Ensure output path ends with .mov
-    if not output_path.endswith('.mov'):
-        output_path = output_path.rsplit('.', 1)[0] + '.mov'
-    
-    # Create video writer with PNG codec for MOV container
-    # This preserves image quality better for steganography
-    fourcc = cv2.VideoWriter_fourcc(*'png ')  # PNG codec with MOV container
-    out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
+    base_path = os.path.splitext(output_path)[0]
+    output_paths = {fmt: base_path + output_suffix(fmt) for fmt in formats}
+    outputs = [(path, output_args(fmt)) for fmt, path in output_paths.items()]
     
-    # Add frames to video
-    for frame_path in frames:
-        frame = cv2.imread(frame_path)
-        if frame is not None:
-            out.write(frame)
+    # Add frames to video; closing the writer waits for ffmpeg to finish the files
+    writer = FFmpegWriter(outputs, width, height, fps)
+    try:
+        for frame in frames:
+            if frame is not None:
+                with span('video_write'):
+                    writer.write(frame)
+                FRAMES_PROCESSED.inc(pipeline='encode')
+    except BaseException:
+        writer.abort()
+        raise
+    with span('ffmpeg'):
+        writer.close()
+    
+    for path in output_paths.values():
+        print(f"[INFO] Created output video: {path}")
+    return output_paths
+
+def encode_video(video_path, text, encrypted_text, output_path, workers=1, formats=('mp4',), progress=None):
+    """Stream frames from the source video through the border and LSB stages into the output videos
+    
+    workers sets how many frames the border and LSB stages process in parallel,
+    progress(stage, done, total) is told how far the encode has got.
+    Returns ({format: path}, total_frames).
+    """
+    def report(stage, done=None, total=None):
+        if progress is not None:
+            progress(stage, done, total)
+    
+    frames, total_frames = extract_frames(video_path)
+    
+    # The border colours depend on the total frame count, so if fewer frames
+    # decode than the stream holds the video is streamed once more with the real one
+    for _ in range(2):
+        decoded = [0]
+        
+        def counted(frames):
+            for frame in frames:
+                decoded[0] += 1
+                yield frame
+        
+        frames = metered('frame_extraction', counted(frames))
+        frames = add_data_border_to_frames(frames, text, total_frames, workers,
+                                           progress=functools.partial(report, 'encoding'))
+        frames = metered('bordering', frames)
+        frames = metered('lsb_embed', encode_frames(frames, encrypted_text, workers, total_frames))
+        output_paths = create_output_video(frames, video_path, output_path, formats)
+        report('finalizing')
+        
+        if decoded[0] == total_frames:
+            break
+        print(f"[WARNING] Stream holds {total_frames} frames but {decoded[0]} were decoded, re-encoding")
+        frames, total_frames = read_frames(video_path), decoded[0]
+
+    return output_paths, total_frames
+
+# Keyframe index
+# MP4/MOV files list their sync samples in the stss box, which is read
+# directly; other containers are asked of ffprobe when it is installed.
+# Without an index the reader falls back to SEEK_DISTANCE
+def _mp4_boxes(file_obj, start, end):
+    """Yield (type, payload start, end) of the boxes between start and end"""
+    position = start
+    while position + 8 <= end:
+        file_obj.seek(position)
+        size, kind = struct.unpack('>I4s', file_obj.read(8))
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', file_obj.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - position
+        if size < header_size:
+            return
+        yield kind, position + header_size, min(position + size, end)
+        position += size
+
+def _mp4_child(file_obj, box, kind):
+    if box is None:
+        return None
+    for child_kind, start, end in _mp4_boxes(file_obj, *box):
+        if child_kind == kind:
+            return start, end
+    return None
+
+def _mp4_fragmented(file_obj):
+    """Whether samples follow the moov box in movie fragments its sample table does not list"""
+    size = os.fstat(file_obj.fileno()).st_size
+    return any(kind == b'moof' for kind, _, _ in _mp4_boxes(file_obj, 0, size))
+
+def _mp4_video_stbl(file_obj):
+    """Sample table box of the first video track, or None"""
+    moov = _mp4_child(file_obj, (0, os.fstat(file_obj.fileno()).st_size), b'moov')
+    if moov is None:
+        return None
+    for kind, start, end in list(_mp4_boxes(file_obj, *moov)):
+        if kind != b'trak':
+            continue
+        mdia = _mp4_child(file_obj, (start, end), b'mdia')
+        hdlr = _mp4_child(file_obj, mdia, b'hdlr')
+        if hdlr is None:
+            continue
+        file_obj.seek(hdlr[0] + 8)
+        if file_obj.read(4) == b'vide':
+            return _mp4_child(file_obj, _mp4_child(file_obj, mdia, b'minf'), b'stbl')
+    return None
+
+def mp4_keyframes(video_path):
+    """Frame indices of the sync samples of the first video track, or None"""
+    with open(video_path, 'rb') as file_obj:
+        stbl = _mp4_video_stbl(file_obj)
+        if stbl is None or _mp4_fragmented(file_obj):
+            return None
+        stss = _mp4_child(file_obj, stbl, b'stss')
+        if stss is not None:
+            file_obj.seek(stss[0] + 4)
+            count = struct.unpack('>I', file_obj.read(4))[0]
+            samples = np.frombuffer(file_obj.read(4 * count), dtype='>u4')
+            return (samples.astype(np.int64) - 1).tolist()
+        # No sync sample table means every sample is a sync sample
+        stsz = _mp4_child(file_obj, stbl, b'stsz')
+        if stsz is None:
+            return None
+        file_obj.seek(stsz[0] + 8)
+        return range(struct.unpack('>I', file_obj.read(4))[0]) or None
+
+class _BitReader:
+    """Reads the bits and Exp-Golomb codes of an H.264 NAL unit"""
+    
+    def __init__(self, data):
+        # Drop the emulation prevention bytes (00 00 03 -> 00 00)
+        self.bits = np.unpackbits(np.frombuffer(data.replace(b'\x00\x00\x03', b'\x00\x00'), dtype=np.uint8))
+        self.position = 0
+    
+    def read(self, count):
+        value = 0
+        for bit in self.bits[self.position:self.position + count]:
+            value = (value << 1) | int(bit)
+        self.position += count
+        return value
+    
+    def read_ue(self):
+        zeros = 0
+        while self.read(1) == 0:
+            zeros += 1
+            if zeros > 31:
+                raise ValueError("Invalid Exp-Golomb code")
+        return (1 << zeros) - 1 + self.read(zeros)
+
+def mp4_avc_format(video_path):
+    """(profile_idc, level_idc, chroma_format_idc, bit_depth) of the first SPS of an H.264 mp4, or None"""
+    with open(video_path, 'rb') as file_obj:
+        stsd = _mp4_child(file_obj, _mp4_video_stbl(file_obj), b'stsd')
+        if stsd is None:
+            return None
+        # The sample entry's boxes follow the 78 bytes of its VisualSampleEntry fields
+        entry = next(_mp4_boxes(file_obj, stsd[0] + 8, stsd[1]), None)
+        if entry is None or entry[0] not in (b'avc1', b'avc3'):
+            return None
+        avcc = _mp4_child(file_obj, (entry[1] + 78, entry[2]), b'avcC')
+        if avcc is None:
+            return None
+        file_obj.seek(avcc[0])
+        config = file_obj.read(avcc[1] - avcc[0])
+    if len(config) < 8 or config[5] & 0x1f == 0:
+        return None
+    sps_length = struct.unpack('>H', config[6:8])[0]
+    sps = _BitReader(config[8 + 1:8 + sps_length])  # Skip the NAL header byte
+    profile_idc = sps.read(8)
+    sps.read(8)  # Constraint flags
+    level_idc = sps.read(8)
+    sps.read_ue()  # seq_parameter_set_id
+    chroma_format_idc, bit_depth = 1, 8
+    if profile_idc in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        chroma_format_idc = sps.read_ue()
+        if chroma_format_idc == 3:
+            sps.read(1)  # separate_colour_plane_flag
+        bit_depth = sps.read_ue() + 8
+    return profile_idc, level_idc, chroma_format_idc, bit_depth
+
+def ffprobe_keyframes(video_path):
+    """Keyframe indices of the first video stream according to ffprobe, or None"""
+    if shutil.which(FFPROBE_BINARY) is None:
+        return None
+    try:
+        result = subprocess.run(
+            [FFPROBE_BINARY, '-v', 'error', '-select_streams', 'v:0',
+             '-show_entries', 'packet=flags', '-of', 'csv=p=0', video_path],
+            capture_output=True, text=True, timeout=60, check=True)
+    except (subprocess.SubprocessError, OSError):
+        return None
+    return [i for i, flags in enumerate(result.stdout.split()) if 'K' in flags] or None
+
+@functools.lru_cache(maxsize=64)
+def _cached_keyframe_index(video_path, mtime_ns, size):
+    try:
+        keyframes = mp4_keyframes(video_path)
+    except (OSError, struct.error):
+        keyframes = None
+    if keyframes is None:
+        keyframes = ffprobe_keyframes(video_path)
+    return keyframes
+
+def keyframe_index(video_path):
+    """Sorted keyframe indices of a video, built once per file version, or None"""
+    stat = os.stat(video_path)
+    return _cached_keyframe_index(os.path.abspath(video_path), stat.st_mtime_ns, stat.st_size)
+
+# Frame counts
+# The border colours depend on the total frame count, so the encoder and the
+# decoder have to agree on it. OpenCV's CAP_PROP_FRAME_COUNT is exact for
+# MP4/MOV but only estimated from the duration for other containers, and is
+# 0 or negative for streams without one (like MediaRecorder WebM uploads)
+def mp4_frame_count(video_path):
+    """Number of samples in the first video track of an MP4/MOV, or None"""
+    with open(video_path, 'rb') as file_obj:
+        stsz = _mp4_child(file_obj, _mp4_video_stbl(file_obj), b'stsz')
+        if stsz is None or _mp4_fragmented(file_obj):
+            return None
+        file_obj.seek(stsz[0] + 8)
+        return struct.unpack('>I', file_obj.read(4))[0] or None
+
+def ffmpeg_frame_count(video_path):
+    """Number of packets in the first video stream, demuxed by ffmpeg without decoding, or None"""
+    try:
+        result = subprocess.run(
+            [FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-i', video_path,
+             '-map', '0:v:0', '-c', 'copy', '-f', 'framecrc', '-'],
+            capture_output=True, text=True, timeout=60, check=True)
+    except (subprocess.SubprocessError, OSError):
+        return None
+    # One line per packet after the '#' header lines
+    return sum(1 for line in result.stdout.splitlines() if line and not line.startswith('#')) or None
+
+@functools.lru_cache(maxsize=64)
+def _cached_frame_count(video_path, mtime_ns, size):
+    try:
+        count = mp4_frame_count(video_path)
+    except (OSError, struct.error):
+        count = None
+    if count is None:
+        count = ffmpeg_frame_count(video_path)
+    if count is None:
+        cap = cv2.VideoCapture(video_path)
+        count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if count <= 0:
+            # Nothing reports a count, so decode the stream to count it
+            count = 0
+            while cap.grab():
+                count += 1
+        cap.release()
+    return count
+
+def video_frame_count(video_path):
+    """Number of frames in a video, counted once per file version"""
+    stat = os.stat(video_path)
+    return _cached_frame_count(os.path.abspath(video_path), stat.st_mtime_ns, stat.st_size)
+
+class FrameReader:
+    """Reads sets of frames in one forward pass, using the keyframe index to decide where to seek
+    
+    The capture stays open between reads, so reading more frames later carries
+    on from where the last read stopped instead of decoding from the start
+    again. close() releases it.
+    """
+    
+    def __init__(self, video_path):
+        self.video_path = video_path
+        self.keyframes = keyframe_index(video_path)
+        self._cap = None
+        self._position = 0  # index of the frame the capture reads next
+    
+    def close(self):
+        if self._cap is not None:
+            self._cap.release()
+            self._cap = None
+    
+    def _seek_target(self, position, target):
+        """Frame to seek to before reading target from position, or None to grab forward"""
+        if self.keyframes is None:
+            return target if target - position > SEEK_DISTANCE else None
+        # OpenCV decodes forward from the keyframe before the frame it seeks to,
+        # so seeking pays off only when that keyframe is well past the position
+        k = bisect.bisect_right(self.keyframes, target) - 1
+        if k < 0 or self.keyframes[k] - position <= KEYFRAME_SEEK_COST:
+            return None
+        return target
     
-    out.release()
-    print(f"[INFO] Created output video: {output_path}")
-    return output_path
+    def iter_frames(self, indices):
+        """Yield (index, frame) for the readable frames among indices, in order"""
+        wanted = sorted(set(i for i in indices if i >= 0))
+        if not wanted:
+            return
+        
+        if self._cap is None:
+            self._cap = cv2.VideoCapture(self.video_path)
+            self._position = 0
+        cap = self._cap
+        seeks = 0
+        read = 0
+        for target in wanted:
+            # Frames before the position, read by an earlier pass, need a seek back
+            seek_to = target if target < self._position else self._seek_target(self._position, target)
+            if seek_to is not None:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, seek_to)
+                self._position = seek_to
+                seeks += 1
+            while self._position < target and cap.grab():
+                self._position += 1
+            ret, frame = cap.read() if self._position == target else (False, None)
+            if not ret:
+                # Past the real end of the stream, nothing further is readable;
+                # the next read starts over with a fresh capture
+                self.close()
+                break
+            self._position += 1
+            read += 1
+            yield target, frame
+        index_kind = 'keyframe index' if self.keyframes is not None else 'no keyframe index'
+        print(f"[INFO] Read {read} frames in one pass with {seeks} seeks ({index_kind})")
+    
+    def read_many(self, indices, progress=None):
+        """Return {index: frame} for the readable frames among indices
+        
+        progress(done, total) is called after each frame.
+        """
+        total = len(set(i for i in indices if i >= 0))
+        frames = {}
+        for index, frame in self.iter_frames(indices):
+            frames[index] = frame
+            if progress is not None:
+                progress(len(frames), total)
+        return frames
+
+# Sparse encoding
+# The payload only changes the first frames, so in sparse mode just those
+# (and, with SPARSE_PERIODIC_BORDERS, the frames the decoder samples for
+# border data) are bordered and LSB-encoded. Only the GOPs holding them are
+# decoded and re-encoded, keyframes where the source has them so the
+# decoder picks the same samples; the other GOPs are stream-copied from the
+# upload and everything is joined with ffmpeg's concat demuxer, whose automatic
+# Annex B conversion keeps each piece's own parameter sets in band. The
+# re-encoded GOPs use the source's profile, level and chroma format, so the
+# track stays one conformant stream; that means chroma subsampling for most
+# sources, which blurs the single-pixel border bits, so the few re-encoded
+# GOPs get SPARSE_CRF for their luma to keep every bit. Needs an 8-bit H.264 mp4 source
+# with a keyframe index and only produces mp4
+ENCODE_MODES = ('full', 'sparse')
+SPARSE_PERIODIC_BORDERS = os.environ.get('SPARSE_PERIODIC_BORDERS', '0') == '1'
+SPARSE_CODECS = ('avc1', 'h264', 'x264')  # FourCCs OpenCV reports for H.264
+SPARSE_PROFILES = {66: 'baseline', 77: 'main', 100: 'high', 122: 'high422', 244: 'high444'}  # x264 profile by profile_idc
+SPARSE_PIX_FMTS = {1: 'yuv420p', 2: 'yuv422p', 3: 'yuv444p'}  # pixel format by chroma_format_idc
+SPARSE_CRF = int(os.environ.get('SPARSE_CRF', 12))  # quality of the re-encoded GOPs
+
+def sparse_runs(keyframes, frame_count, modified):
+    """Merge the GOPs holding the modified frames into sorted (start, stop) frame ranges"""
+    bounds = [k for k in keyframes if k < frame_count] + [frame_count]
+    runs = []
+    for index in sorted(modified):
+        gop = bisect.bisect_right(bounds, index) - 1
+        start, stop = bounds[gop], bounds[gop + 1]
+        if runs and runs[-1][1] >= start:
+            runs[-1] = (runs[-1][0], max(runs[-1][1], stop))
+        else:
+            runs.append((start, stop))
+    return runs
 
-def decode_video(video_path, temp_dir):
-    """Decode hidden text from video"""
-    # Create a temporary directory similar to the original code
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
+def _run_ffmpeg(command, message):
+    with span('ffmpeg'):
+        process = subprocess.run([FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-y'] + command,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise FFmpegError(f"{message}: {process.stderr.decode(errors='replace').strip()}")
+
+def _split_stream(video_path, boundaries, segment_dir):
+    """Stream-copy the video track into pieces starting at the given keyframes"""
+    pattern = os.path.join(segment_dir, 'copy%05d.mp4')
+    command = ['-i', video_path, '-map', '0:v:0', '-c', 'copy', '-f', 'segment',
+               '-segment_format', 'mp4', '-reset_timestamps', '1']
+    if boundaries:
+        command += ['-segment_frames', ','.join(str(b) for b in boundaries)]
+    _run_ffmpeg(command + [pattern], "Error splitting video")
+    return [pattern % i for i in range(len(boundaries) + 1)]
+
+def encode_video_sparse(video_path, text, encrypted_text, output_path, progress=None):
+    """Border and LSB-encode only the payload frames, re-encoding just the GOPs holding them
+    
+    Returns ({'mp4': path}, total_frames), or None if the source cannot be
+    stream-copied and needs a full encode.
+    """
+    def report(stage, done=None, total=None):
+        if progress is not None:
+            progress(stage, done, total)
     
-    # Extract frames using OpenCV directly
+    keyframes = keyframe_index(video_path)
     cap = cv2.VideoCapture(video_path)
-    number_of_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fourcc = int(cap.get(cv2.CAP_PROP_FOURCC)).to_bytes(4, 'little').decode('latin-1').lower()
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+    total_frames = video_frame_count(video_path)
+    if fourcc not in SPARSE_CODECS or not keyframes or keyframes[0] != 0 or total_frames <= 0:
+        print(f"[WARNING] Sparse mode needs H.264 with a keyframe index (got {fourcc!r}), encoding every frame")
+        return None
+    try:
+        stream_format = mp4_avc_format(video_path)
+    except (OSError, struct.error, ValueError):
+        stream_format = None
+    if stream_format is None or stream_format[0] not in SPARSE_PROFILES \
+            or stream_format[2] not in SPARSE_PIX_FMTS or stream_format[3] != 8:
+        print(f"[WARNING] Cannot re-encode GOPs to match the source's H.264 format {stream_format}, encoding every frame")
+        return None
+    profile_idc, level_idc, chroma_format_idc, _ = stream_format
+    # The copied GOPs keep the source's parameter sets, so the re-encoded ones match them
+    format_args = ['-profile:v', SPARSE_PROFILES[profile_idc], '-level:v', str(level_idc),
+                   '-pix_fmt', SPARSE_PIX_FMTS[chroma_format_idc]]
+    
+    # Frames that change: the payload frames and optionally the border samples
+    payload_frames = len(split_string(encrypted_text, max(1, min(10, total_frames))))
+    bordered = set(range(payload_frames))
+    if SPARSE_PERIODIC_BORDERS:
+        bordered.update(border_candidate_indices(total_frames, keyframes))
+    runs = sparse_runs(keyframes, total_frames, bordered)
+    modified = sum(stop - start for start, stop in runs)
+    print(f"[INFO] Re-encoding {modified} of {total_frames} frames in {len(runs)} GOP runs")
+    
+    base_path = os.path.splitext(output_path)[0]
+    segment_dir = f"{base_path}_segments"
+    os.makedirs(segment_dir, exist_ok=True)
+    reader = FrameReader(video_path)  # One capture reads the runs in order
+    try:
+        # Pieces alternate between copied and re-encoded ranges
+        edges = sorted({0, total_frames}.union(*runs))
+        copies = _split_stream(video_path, edges[1:-1], segment_dir) if modified < total_frames else None
+        
+        full_data = f"STEGO:{text}"
+        pieces = []
+        done = 0
+        for i, (start, stop) in enumerate(zip(edges, edges[1:])):
+            if (start, stop) not in runs:
+                # Stream copy; the split only cuts on keyframes, so check it cut where asked
+                cap = cv2.VideoCapture(copies[i])
+                copied = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+                cap.release()
+                if copied != stop - start:
+                    raise FFmpegError(f"Stream copy of frames {start}-{stop} holds {copied} frames")
+                pieces.append(copies[i])
+                continue
+            
+            frames = metered('frame_extraction', (frame for _, frame in reader.iter_frames(range(start, stop))))
+            frames = metered('bordering', (
+                _border_stage(full_data, total_frames, 20, index, frame) if index in bordered else frame
+                for index, frame in enumerate(frames, start)))
+            if start == 0:
+                frames = metered('lsb_embed', encode_frames(frames, encrypted_text, total_frames=total_frames))
+            
+            # Keyframes exactly where the source has them, so the output has the same keyframe index
+            args = output_args('mp4') + format_args + ['-g', str(stop - start + 1), '-sc_threshold', '0']
+            args[args.index('-crf') + 1] = str(SPARSE_CRF)
+            inner = [k - start for k in keyframes if start < k < stop]
+            if inner:
+                args += ['-force_key_frames', 'expr:' + '+'.join(f'eq(n,{k})' for k in inner)]
+            
+            path = os.path.join(segment_dir, f"encoded{i:05d}.mp4")
+            written = 0
+            with FFmpegWriter([(path, args)], width, height, fps) as writer:
+                for frame in frames:
+                    with span('video_write'):
+                        writer.write(frame)
+                    written += 1
+                    FRAMES_PROCESSED.inc(pipeline='encode')
+                    report('encoding', done + written, modified)
+            if written != stop - start:
+                raise ValueError(f"Decoded {written} of the {stop - start} frames from {start}")
+            done += written
+            pieces.append(path)
+        
+        report('finalizing')
+        list_path = os.path.join(segment_dir, 'pieces.txt')
+        with open(list_path, 'w') as list_file:
+            list_file.writelines(f"file '{os.path.basename(path)}'\n" for path in pieces)
+        mp4_path = f"{base_path}.mp4"
+        _run_ffmpeg(['-f', 'concat', '-i', list_path, '-c', 'copy', '-an', mp4_path], "Error joining video")
+    finally:
+        reader.close()
+        remove_temp_dir(segment_dir)
     
-    print(f"[INFO] Video has {number_of_frames} frames")
+    print(f"[INFO] Created output video: {mp4_path}")
+    return {'mp4': mp4_path}, total_frames
+
+# Batch encoding
+# Several payloads go into copies of one upload. The source is decoded once
+# and every decoded frame is handed to all variants, which border, LSB-encode
+# and write their own copy of it on their own thread
+MAX_BATCH_TEXTS = int(os.environ.get('MAX_BATCH_TEXTS', 8))
+
+def _timed(func, *args):
+    """Run func on a helper thread with its own StageTimer, returning (result, timer)"""
+    timer = start_timer()
+    return func(*args), timer
+
+class BatchAborted(Exception):
+    """A batch variant stopped because another one failed"""
+
+def _gather_variants(futures, timer):
+    """Wait until every variant has stopped, then return their results or raise the first failure"""
+    wait(futures)
+    errors = [future.exception() for future in futures if future.exception() is not None]
+    if errors:
+        # Variants that only stopped for another's failure do not hide its error
+        raise next((e for e in errors if not isinstance(e, BatchAborted)), errors[0])
+    results = []
+    for future in futures:
+        result, variant_timer = future.result()
+        timer.merge(variant_timer)
+        results.append(result)
+    return results
+
+def _put_unless(window, item, failed):
+    """Put item into a variant's frame window, giving up once any variant failed"""
+    while not failed.is_set():
+        try:
+            window.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _encode_variant(video_path, variant, window, failed, total_frames, formats, workers):
+    """Border, LSB-encode and write one variant from the shared frames arriving in window"""
+    text, encrypted_text, output_path = variant
+    
+    def own_frames():
+        while True:
+            try:
+                frame = window.get(timeout=0.1)
+            except queue.Empty:
+                # No more frames are coming once any variant failed
+                if failed.is_set():
+                    raise BatchAborted("Another variant of the batch failed")
+                continue
+            if frame is None:
+                return
+            yield frame.copy()  # The other variants still need the original
     
-    # Check for data in borders first
-    border_data = extract_border_data(video_path, temp_dir)
-    if border_data:
-        print(f"[INFO] Extracted data from borders: {border_data[:30]}...")
+    try:
+        frames = metered('frame_extraction', own_frames())
+        frames = metered('bordering', add_data_border_to_frames(frames, text, total_frames, workers))
+        frames = metered('lsb_embed', encode_frames(frames, encrypted_text, workers, total_frames))
+        return create_output_video(frames, video_path, output_path, formats)
+    except BaseException:
+        failed.set()
+        raise
+
+def encode_video_batch(video_path, variants, formats=('mp4',), workers=1, mode='full'):
+    """Hide several payloads in copies of one video
+    
+    variants is a list of (text, encrypted_text, output_path). Stage times of
+    the variant threads are added to the caller's timer. Returns
+    ([{format: path}, ...], total_frames).
+    """
+    timer = current_timer()
+    with ThreadPoolExecutor(len(variants), thread_name_prefix='batch-variant') as executor:
+        # Sparse variants only decode the GOPs they change, so they run on their own
+        if mode == 'sparse':
+            futures = [executor.submit(_timed, encode_video_sparse, video_path, *variant) for variant in variants]
+            results = _gather_variants(futures, timer)
+            if all(result is not None for result in results):
+                return [paths for paths, _ in results], results[0][1]
+        
+        frames, total_frames = extract_frames(video_path)
+        
+        # As in encode_video, frames that fail to decode mean one more pass with the real count
+        for _ in range(2):
+            windows = [queue.Queue(FRAME_WINDOW) for _ in variants]
+            failed = threading.Event()
+            futures = [executor.submit(_timed, _encode_variant, video_path, variant, window, failed,
+                                       total_frames, formats, workers)
+                       for variant, window in zip(variants, windows)]
+            decoded = 0
+            try:
+                for frame in frames:
+                    decoded += 1
+                    if not all(_put_unless(window, frame, failed) for window in windows):
+                        break
+            except BaseException:
+                failed.set()  # Stops the variants instead of letting them write partial outputs
+                raise
+            finally:
+                frames.close()
+                # Variants notice a failure by themselves, so the end marker only goes to running ones
+                for window in windows:
+                    _put_unless(window, None, failed)
+            
+            output_paths = _gather_variants(futures, timer)
+            
+            if decoded == total_frames:
+                break
+            print(f"[WARNING] Stream holds {total_frames} frames but {decoded} were decoded, re-encoding")
+            frames, total_frames = read_frames(video_path), decoded
+    
+    return output_paths, total_frames
+
+class FramePlan:
+    """Collects the frame indices the decode stages need and serves them from shared reads
+    
+    Every requested frame is decoded once: wanted indices are read by a
+    FrameReader in a single forward pass, and the decoded frames are kept for
+    all stages. Stages that do not know up front how many frames they need,
+    like border sampling, pull them through iter_frames, still in one pass.
+    All reads share the reader's capture until close().
+    """
+    
+    def __init__(self, video_path, progress=None):
+        self.video_path = video_path
+        self.progress = progress  # progress(done, total) while frames are read
+        self.reader = FrameReader(video_path)
+        self.frame_count = video_frame_count(video_path)  # The count the encoder coloured the border with
+        self._wanted = set()
+        self._frames = {}
+        self._unreadable = set()
+    
+    def close(self):
+        self.reader.close()
+    
+    def request(self, indices):
+        """Register frames a stage will need"""
+        self._wanted.update(i for i in indices if i >= 0)
+    
+    def fetch(self):
+        """Read every requested frame that is not cached yet"""
+        missing = sorted(self._wanted - self._frames.keys() - self._unreadable)
+        self._wanted.clear()
+        if not missing:
+            return
+        
+        with span('frame_extraction'):
+            frames = self.reader.read_many(missing, self.progress)
+        FRAMES_PROCESSED.inc(len(frames), pipeline='decode')
+        self._frames.update(frames)
+        self._unreadable.update(i for i in missing if i not in frames)
+    
+    def get(self, index):
+        """Return a decoded frame, or None if it cannot be read"""
+        if index not in self._frames and index not in self._unreadable:
+            self.request([index])
+            self.fetch()
+        return self._frames.get(index)
+    
+    def get_many(self, indices):
+        """Return {index: frame} for the readable frames among indices"""
+        self.request(indices)
+        self.fetch()
+        return {i: self._frames[i] for i in indices if i in self._frames}
+    
+    def iter_frames(self, indices):
+        """Yield (index, frame) for the readable frames among indices, in order
+        
+        Frames that are not cached yet are read by one FrameReader pass as the
+        caller gets to them, so stopping early leaves the rest unread.
+        """
+        indices = sorted(set(i for i in indices if i >= 0))
+        reads = self.reader.iter_frames([i for i in indices if i not in self._frames and i not in self._unreadable])
+        try:
+            for index in indices:
+                while index not in self._frames and index not in self._unreadable:
+                    with span('frame_extraction'):
+                        read = next(reads, None)
+                    # The pass skips frames it cannot read
+                    if read is None or read[0] > index:
+                        self._unreadable.add(index)
+                    if read is not None:
+                        self._frames[read[0]] = read[1]
+                        FRAMES_PROCESSED.inc(pipeline='decode')
+                if index in self._frames:
+                    yield index, self._frames[index]
+        finally:
+            reads.close()
+
+def border_sample_indices(frame_count):
+    """Frames sampled for border data, spread evenly over the video"""
+    samples = min(BORDER_SAMPLES, frame_count)  # Use fewer samples for quicker processing
+    return [int(i * frame_count / samples) for i in range(samples)]
+
+def metadata_probe_indices(frame_count):
+    """Frames at the end of the video that may hold the metadata frame of older encodes"""
+    return list(range(max(0, frame_count - METADATA_PROBE_FRAMES), frame_count))
+
+def plan_decode(video_path, progress=None):
+    """Create a FramePlan for the /decrypt stages, holding frame 0
+    
+    Border sampling reads its frames through the plan as it goes, and the
+    payload reader requests the frames frame 0's header lists.
+    """
+    plan = FramePlan(video_path, progress)
+    plan.request([0])  # Payload header, and the first frame sampled for border data
+    plan.fetch()
+    return plan
+
+def read_payload(plan, record, layout):
+    """Collect the payload parts listed in frame 0's header"""
+    key_id, payload_length, frame_indices, header_size = layout
+    print(f"[INFO] Payload header: {payload_length} bytes in frames {frame_indices}, key {key_id.hex()}")
+    frames = plan.get_many([fn for fn in frame_indices if fn != 0])
+    
+    parts = []
+    for frame_number in frame_indices:
+        if frame_number == 0:
+            part = record[header_size:]
+        else:
+            frame = frames.get(frame_number)
+            part = lsb_extract(frame, compat=False) if frame is not None else None
+        if part is None:
+            print(f"[ERROR] Could not read payload frame {frame_number}")
+            return None
+        parts.append(part)
+        print(f"Frame {frame_number} DECODED: {len(part)} bytes")
+    
+    payload = b"".join(parts)
+    if len(payload) != payload_length:
+        print(f"[ERROR] Payload has {len(payload)} bytes, header says {payload_length}")
+        return None
+    return payload
+
+def read_legacy_payload(plan):
+    """Collect the payload of videos encoded before the frame 0 header
+    
+    Those list their payload frames in a metadata frame near the end, or
+    else spread it over the first frames.
+    """
+    number_of_frames = plan.frame_count
+    plan.request(metadata_probe_indices(number_of_frames))
+    plan.request(range(min(LSB_FALLBACK_FRAMES, number_of_frames)))
+    plan.fetch()
     
     # First check if there's a metadata frame by looking at the last frames
     metadata_frame_numbers = []
     
     # Check the last 5 frames for metadata
     print("[INFO] Looking for metadata frame...")
-    for frame_index in range(max(0, number_of_frames - 5), number_of_frames):
-        # Jump to frame
-        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
-        ret, frame = cap.read()
-        if not ret:
+    for frame_index in metadata_probe_indices(number_of_frames):
+        frame = plan.get(frame_index)
+        if frame is None:
             continue
             
-        # Save frame and try to decode it
-        metadata_frame_path = os.path.join(temp_dir, f"metadata_check_{frame_index}.png")
-        cv2.imwrite(metadata_frame_path, frame)
-        
-        try:
-            metadata_content = lsb.reveal(metadata_frame_path)
-            if metadata_content and ',' in metadata_content:
-                # This looks like our metadata frame
-                print(f"[INFO] Found potential metadata at frame {frame_index}: {metadata_content}")
-                try:
-                    # Try to parse the frame numbers
-                    frame_nums = [int(num) for num in metadata_content.split(',')]
-                    metadata_frame_numbers = frame_nums
-                    print(f"[INFO] Using frame numbers from metadata: {frame_nums}")
-                    break
-                except:
-                    print(f"[INFO] Failed to parse metadata numbers: {metadata_content}")
-        except Exception as e:
-            pass
-    
-    # Reset the video capture
-    cap.release()
-    cap = cv2.VideoCapture(video_path)
+        metadata_content = lsb_extract(frame)
+        if metadata_content and b',' in metadata_content:
+            # This looks like our metadata frame
+            metadata_content = metadata_content.decode('ascii', errors='replace')
+            print(f"[INFO] Found potential metadata at frame {frame_index}: {metadata_content}")
+            try:
+                # Try to parse the frame numbers
+                frame_nums = [int(num) for num in metadata_content.split(',')]
+                metadata_frame_numbers = frame_nums
+                print(f"[INFO] Using frame numbers from metadata: {frame_nums}")
+                break
+            except ValueError:
+                print(f"[INFO] Failed to parse metadata numbers: {metadata_content}")
     
     # Frames to check - either from metadata or first 15 frames if no metadata
-    frames_to_check = metadata_frame_numbers if metadata_frame_numbers else list(range(15))
+    frames_to_check = metadata_frame_numbers if metadata_frame_numbers else list(range(LSB_FALLBACK_FRAMES))
     print(f"[INFO] Will check these frames: {frames_to_check}")
     
+    # Anything the plan did not read up front is fetched in one more pass
+    checked_frames = plan.get_many([fn for fn in frames_to_check if fn < number_of_frames])
+    
     # Process frames - using targeted frame extraction if metadata is available
     decoded = {}
     
@@ -349,44 +1869,83 @@ def decode_video(video_path, temp_dir):
             print(f"[WARNING] Frame number {frame_number} exceeds video length")
             continue
             
-        # Jump to the specific frame
-        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
-        ret, frame = cap.read()
-        if not ret:
+        frame = checked_frames.get(frame_number)
+        if frame is None:
             print(f"[ERROR] Could not read frame {frame_number}")
             continue
         
-        encoded_frame_file_name = os.path.join(temp_dir, f"{frame_number}-enc.png")
-        cv2.imwrite(encoded_frame_file_name, frame)
-        
         # Try to decode the frame
-        try:
-            clear_message = lsb.reveal(encoded_frame_file_name)
-            if clear_message:
-                decoded[frame_number] = clear_message
-                print(f"Frame {frame_number} DECODED: {clear_message}")
-        except Exception as e:
-            print(f"Error decoding frame {frame_number}: {e}")
+        clear_message = lsb_extract(frame)
+        if clear_message:
+            decoded[frame_number] = clear_message
+            print(f"Frame {frame_number} DECODED: {len(clear_message)} bytes")
     
-    # Arrange and decrypt the message
-    res = ""
-    for fn in sorted(decoded.keys()):
-        res += decoded[fn]
+    # Arrange the message
+    return b"".join(decoded[fn] for fn in sorted(decoded.keys()))
+
+def decode_video(video_path, plan=None, border_data=None):
+    """Decode hidden text from video
+    
+    Pass the FramePlan (and border data) already used for the same video to
+    avoid decoding any frame twice.
+    """
+    if plan is None:
+        with contextlib.closing(plan_decode(video_path)) as plan:
+            return decode_video(video_path, plan, border_data)
+    
+    print(f"[INFO] Video has {plan.frame_count} frames")
+    
+    # Check for data in borders first
+    if border_data is None:
+        border_data = extract_border_data(video_path, plan)
+    if border_data:
+        print(f"[INFO] Extracted data from borders: {border_data[:30]}...")
+    
+    decrypted, res = reveal_payload(plan)
+    if decrypted is not None:
+        return decrypted
+    
+    # If no steganography data was found or it could not be decrypted, return border data
+    if border_data:
+        if res:
+            print(f"[INFO] Returning border data instead: {border_data[:30]}...")
+        return border_data
+    return res.decode('utf-8', errors='replace') if res else None  # Otherwise return the encoded message
+
+def reveal_payload(plan):
+    """Read and decrypt the LSB payload of a planned video
+    
+    Returns (text, payload): text is None unless the payload decrypted, and
+    payload is None if the video holds none that this server can read.
+    """
+    # Frame 0 says where the payload is; without any record there is nothing to read
+    frame = plan.get(0)
+    record = lsb_extract(frame) if frame is not None else None
+    if not record:
+        print("[INFO] Frame 0 holds no payload")
+        return None, None
+    
+    layout = unpack_payload_header(record)
+    if layout is None:
+        print("[INFO] No payload header in frame 0, trying the legacy layout")
+        res = read_legacy_payload(plan)
+    elif layout[0] != bytes(KEY_ID_SIZE) and keyring.get(layout[0]) is None:
+        print(f"[ERROR] Payload was encrypted with unknown key {layout[0].hex()}")
+        return None, None
+    else:
+        res = read_payload(plan, record, layout)
     
     if not res:
-        return border_data if border_data else None  # If no steganography data found, return border data
+        return None, None
     
     try:
         # Try to decrypt the message
-        decrypted_message = decrypt_rsa(res)
-        return decrypted_message.decode('utf-8')
+        with span('rsa'):
+            decrypted_message = decrypt_rsa(res)
+        return decrypted_message.decode('utf-8'), res
     except Exception as e:
         print(f"Error decrypting message: {e}")
-        # If decryption fails but we have border data, return that instead
-        if border_data:
-            print(f"[INFO] Returning border data instead: {border_data[:30]}...")
-            return border_data
-        return res  # Otherwise return the encoded message
+        return None, res
 
 def text_to_binary(text):
     """Convert text to binary string"""
@@ -394,166 +1953,212 @@ def text_to_binary(text):
         text = text.encode('utf-8')
     return ''.join(format(byte, '08b') for byte in text)
 
+# Lookup table of the byte values kept when decoding text (printable ASCII)
+_PRINTABLE_BYTES = np.zeros(256, dtype=bool)
+_PRINTABLE_BYTES[32:127] = True
+
+def bits_to_text(bits):
+    """Pack a 0/1 array into bytes and keep only printable ASCII characters"""
+    packed = np.packbits(np.asarray(bits, dtype=np.uint8))
+    return packed[_PRINTABLE_BYTES[packed]].tobytes().decode('ascii')
+
 def binary_to_text(binary):
     """Convert binary string to text with basic error handling"""
-    if not binary or len(binary) < 8:
-        return ""
-        
-    # Make sure binary string length is a multiple of 8
-    binary = binary.ljust((len(binary) // 8 + 1) * 8, '0')
-    
-    # Group into bytes
-    bytes_list = [binary[i:i+8] for i in range(0, len(binary), 8)]
-    
-    # Convert each byte to a character
-    text = ""
-    for byte in bytes_list:
-        try:
-            # Convert binary to integer, then to character
-            char_code = int(byte, 2)
-            # Only keep printable ASCII characters
-            if 32 <= char_code <= 126:
-                text += chr(char_code)
-        except ValueError:
-            pass
-    
-    return text
-
-def create_data_border(frame, data, frame_index, total_frames, border_width=20):
-    """Create border that encodes data in the top-left corner while adding decorative elements elsewhere"""
-    # Make a copy to avoid modifying the original
-    bordered_frame = frame.copy()
-    height, width = bordered_frame.shape[:2]
-    
-    # Convert data to binary
-    binary_data = text_to_binary(data)
-    
-    # Calculate which portion of the data to encode in this frame
-    bits_per_frame = min(len(binary_data), (2 * (width + height) - 4 * border_width) // 2)
-    start_index = (frame_index * bits_per_frame // 3) % len(binary_data)  # Overlap by 2/3 for redundancy
+    if not binary or len(binary) < 8:
+        return ""
     
-    # Extract the portion of data for this frame
-    frame_data = binary_data[start_index:start_index + bits_per_frame]
-    if len(frame_data) < bits_per_frame:
-        frame_data += binary_data[:bits_per_frame - len(frame_data)]  # Wrap around
+    # Make sure binary string length is a multiple of 8
+    binary = binary.ljust(-(-len(binary) // 8) * 8, '0')
     
-    # Generate colors for 0 and 1 bits
+    # Group into bytes, dropping any byte that is not made of 0s and 1s
+    digits = np.frombuffer(binary.encode('ascii', errors='replace'), dtype=np.uint8) - ord('0')
+    digits = digits.reshape(-1, 8)
+    return bits_to_text(digits[(digits <= 1).all(axis=1)])
+
+@functools.lru_cache(maxsize=64)
+def _data_bits(data):
+    """Bits of the border data as a uint8 array, shared by every frame of a video"""
+    bits = np.unpackbits(np.frombuffer(data.encode('utf-8'), dtype=np.uint8))
+    bits.setflags(write=False)
+    return bits
+
+@functools.lru_cache(maxsize=1024)
+def _bit_colors(frame_index, total_frames):
+    """BGR colours for '0' and '1' bits of a frame"""
     # Use frame index to create subtle color variations between frames
-    hue_shift = (frame_index / total_frames) * 0.3  # Shift hue by up to 0.3
+    hue_shift = (frame_index / max(total_frames, 1)) * 0.3  # Shift hue by up to 0.3
     
     # Color for '0' bit - dark blue to purple range
     zero_hue = (0.6 + hue_shift) % 1.0
     zero_color = tuple(int(x * 255) for x in colorsys.hsv_to_rgb(zero_hue, 0.7, 0.4))
-    zero_color = (zero_color[2], zero_color[1], zero_color[0])  # Convert to BGR
     
     # Color for '1' bit - orange to red range
     one_hue = (0.05 + hue_shift) % 1.0
     one_color = tuple(int(x * 255) for x in colorsys.hsv_to_rgb(one_hue, 0.9, 0.7))
-    one_color = (one_color[2], one_color[1], one_color[0])  # Convert to BGR
     
-    # Calculate the corner size
+    # Convert to BGR
+    return np.array([zero_color[::-1], one_color[::-1]], dtype=np.uint8)
+
+def _draw_strip_patterns(canvas, offset_x, offset_y, width, height, border_width, phase, fill=None):
+    """Draw the translucent strip pattern for one frame phase onto a canvas placed at the given offset
+    
+    When fill is given every segment is drawn with it, which renders the pattern mask.
+    """
     corner_size = border_width * 2
+    segment_width = 2  # Each segment takes 2 pixels width
     
-    # KEEP EXISTING TOP-LEFT CORNER ENCODING (DON'T MODIFY THIS PART)
-    # Encode data in the top-left corner only
-    data_pos = 0
-    segment_width = 2  # Each bit takes 2 pixels width
-    
-    # Top-left corner area
-    for y in range(corner_size):
-        for x in range(corner_size):
-            if data_pos < len(frame_data):
-                bit = int(frame_data[data_pos])
-                color = one_color if bit else zero_color
-                bordered_frame[y, x] = color
-                data_pos += 1
+    def rectangle(pt1, pt2, color):
+        cv2.rectangle(canvas, (pt1[0] - offset_x, pt1[1] - offset_y),
+                      (pt2[0] - offset_x, pt2[1] - offset_y), color if fill is None else fill, -1)
+    
+    # Top border (excluding corners)
+    for x in range(corner_size, width - corner_size, segment_width * 2):
+        # Random-looking pattern based on position and frame
+        pattern_value = (x + phase) % 8  
+        if pattern_value < 4:  # Create alternating pattern
+            color = (30 + pattern_value * 20, 30 + pattern_value * 10, 150 - pattern_value * 10)
+            rectangle((x, 0), (x + segment_width * 2 - 1, border_width - 1), color)
+    
+    # Right border (excluding corners)
+    for y in range(corner_size, height - corner_size, segment_width * 2):
+        pattern_value = (y + phase) % 8
+        if pattern_value < 4:
+            color = (30 + pattern_value * 10, 150 - pattern_value * 10, 30 + pattern_value * 20)
+            rectangle((width - border_width, y), (width - 1, y + segment_width * 2 - 1), color)
+    
+    # Bottom border (excluding corners)
+    for x in range(width - corner_size, corner_size, -(segment_width * 2)):
+        pattern_value = (x + phase) % 8
+        if pattern_value < 4:
+            color = (150 - pattern_value * 10, 30 + pattern_value * 10, 30 + pattern_value * 20)
+            rectangle((x - segment_width * 2 + 1, height - border_width), (x, height - 1), color)
+    
+    # Left border (excluding corners)
+    for y in range(height - corner_size, corner_size, -(segment_width * 2)):
+        pattern_value = (y + phase) % 8
+        if pattern_value < 4:
+            color = (30 + pattern_value * 20, 150 - pattern_value * 10, 30 + pattern_value * 10)
+            rectangle((0, y - segment_width * 2 + 1), (border_width - 1, y), color)
+
+@functools.lru_cache(maxsize=32)
+def _border_template(width, height, border_width):
+    """Precompute the static decoration of a border for one frame geometry
+    
+    Returns the three decorative corner patches and, for each of the 8 pattern
+    phases (frame_index % 8), the colour and mask of the four strip ROIs.
+    Everything is perimeter-sized, only the corner rendering touches a full canvas once.
+    """
+    corner_size = border_width * 2
     
     # ADD DECORATIVE CORNERS TO THE OTHER THREE CORNERS
     # These won't contain actual data but will help with corner detection
+    canvas = np.zeros((height, width, 3), dtype=np.uint8)
     
     # Top-right corner (decorative)
     tr_color = (30, 180, 30)  # Green
-    cv2.rectangle(bordered_frame, (width - corner_size, 0), (width, corner_size), tr_color, -1)
+    cv2.rectangle(canvas, (width - corner_size, 0), (width, corner_size), tr_color, -1)
     # Add diagonal lines for a distinctive pattern
     for i in range(0, corner_size, 4):
-        cv2.line(bordered_frame, (width - corner_size, i), (width - corner_size + i, 0), (255, 255, 255), 1)
+        cv2.line(canvas, (width - corner_size, i), (width - corner_size + i, 0), (255, 255, 255), 1)
     
     # Bottom-left corner (decorative)
     bl_color = (180, 30, 30)  # Blue
-    cv2.rectangle(bordered_frame, (0, height - corner_size), (corner_size, height), bl_color, -1)
+    cv2.rectangle(canvas, (0, height - corner_size), (corner_size, height), bl_color, -1)
     # Add circular pattern
-    cv2.circle(bordered_frame, (corner_size // 2, height - corner_size // 2), 
+    cv2.circle(canvas, (corner_size // 2, height - corner_size // 2), 
                corner_size // 3, (255, 255, 255), 2)
     
     # Bottom-right corner (decorative)
     br_color = (180, 180, 30)  # Cyan
-    cv2.rectangle(bordered_frame, (width - corner_size, height - corner_size), (width, height), br_color, -1)
+    cv2.rectangle(canvas, (width - corner_size, height - corner_size), (width, height), br_color, -1)
     # Add square pattern
-    cv2.rectangle(bordered_frame, (width - corner_size + 5, height - corner_size + 5), 
+    cv2.rectangle(canvas, (width - corner_size + 5, height - corner_size + 5), 
                  (width - 5, height - 5), (255, 255, 255), 2)
     
-    # ADD TRANSLUCENT DECORATIVE ELEMENTS TO THE REST OF THE BORDER
-    # This makes it look like there's data without actually encoding anything
-    
-    # Create a border overlay for translucent effects
-    border_overlay = bordered_frame.copy()
-    
-    # Top border (excluding corners)
-    for x in range(corner_size, width - corner_size, segment_width * 2):
-        # Random-looking pattern based on position and frame
-        pattern_value = (x + frame_index) % 8  
-        if pattern_value < 4:  # Create alternating pattern
-            color = (30 + pattern_value * 20, 30 + pattern_value * 10, 150 - pattern_value * 10)
-            cv2.rectangle(border_overlay, (x, 0), (x + segment_width * 2 - 1, border_width - 1), color, -1)
+    # The filled rectangles cover their whole box (inclusive end points)
+    corner_boxes = [
+        (slice(0, corner_size + 1), slice(max(width - corner_size, 0), width)),
+        (slice(max(height - corner_size, 0), height), slice(0, corner_size + 1)),
+        (slice(max(height - corner_size, 0), height), slice(max(width - corner_size, 0), width)),
+    ]
+    corners = [(box, canvas[box].copy()) for box in corner_boxes]
+    del canvas
+    
+    # Strip ROIs (excluding corners) and the bands they are rendered in
+    strips = [
+        # Top
+        ((slice(0, border_width), slice(corner_size, width - corner_size)), (0, 0, width, border_width)),
+        # Right
+        ((slice(corner_size, height - corner_size), slice(width - border_width, width)),
+         (width - border_width, 0, border_width, height)),
+        # Bottom
+        ((slice(height - border_width, height), slice(corner_size, width - corner_size)),
+         (0, height - border_width, width, border_width)),
+        # Left
+        ((slice(corner_size, height - corner_size), slice(0, border_width)), (0, 0, border_width, height)),
+    ]
     
-    # Right border (excluding corners)
-    for y in range(corner_size, height - corner_size, segment_width * 2):
-        pattern_value = (y + frame_index) % 8
-        if pattern_value < 4:
-            color = (30 + pattern_value * 10, 150 - pattern_value * 10, 30 + pattern_value * 20)
-            cv2.rectangle(border_overlay, (width - border_width, y), 
-                         (width - 1, y + segment_width * 2 - 1), color, -1)
+    phases = []
+    for phase in range(8):
+        strip_templates = []
+        for roi, (band_x, band_y, band_w, band_h) in strips:
+            colors = np.zeros((max(band_h, 0), max(band_w, 0), 3), dtype=np.uint8)
+            mask = np.zeros((max(band_h, 0), max(band_w, 0)), dtype=np.uint8)
+            _draw_strip_patterns(colors, band_x, band_y, width, height, border_width, phase)
+            _draw_strip_patterns(mask, band_x, band_y, width, height, border_width, phase, fill=255)
+            
+            # Cut the ROI out of the band
+            local = (slice(roi[0].start - band_y, roi[0].stop - band_y),
+                     slice(roi[1].start - band_x, roi[1].stop - band_x))
+            mask = np.repeat(mask[local][..., np.newaxis] > 0, 3, axis=2)
+            strip_templates.append((roi, colors[local].copy(), mask))
+        phases.append(strip_templates)
+    
+    return corners, phases
+
+def create_data_border(frame, data, frame_index, total_frames, border_width=20, copy=True):
+    """Create border that encodes data in the top-left corner while adding decorative elements elsewhere
     
-    # Bottom border (excluding corners)
-    for x in range(width - corner_size, corner_size, -(segment_width * 2)):
-        pattern_value = (x + frame_index) % 8
-        if pattern_value < 4:
-            color = (150 - pattern_value * 10, 30 + pattern_value * 10, 30 + pattern_value * 20)
-            cv2.rectangle(border_overlay, (x - segment_width * 2 + 1, height - border_width), 
-                         (x, height - 1), color, -1)
+    Only the corners and the four border strips are written. Pass copy=False
+    to draw straight onto a frame the caller owns.
+    """
+    # Make a copy to avoid modifying the original
+    bordered_frame = frame.copy() if copy else frame
+    height, width = bordered_frame.shape[:2]
     
-    # Left border (excluding corners)
-    for y in range(height - corner_size, corner_size, -(segment_width * 2)):
-        pattern_value = (y + frame_index) % 8
-        if pattern_value < 4:
-            color = (30 + pattern_value * 20, 150 - pattern_value * 10, 30 + pattern_value * 10)
-            cv2.rectangle(border_overlay, (0, y - segment_width * 2 + 1), 
-                         (border_width - 1, y), color, -1)
+    # Convert data to binary
+    binary_data = _data_bits(data)
     
-    # Blend the overlay with the original frame for translucent effect
-    alpha = 0.6  # Translucency level (0.0 to 1.0)
-    # Apply the translucent border overlay to the bordered frame
-    # But preserve the top-left corner which contains actual data
+    # Calculate which portion of the data to encode in this frame
+    bits_per_frame = min(len(binary_data), (2 * (width + height) - 4 * border_width) // 2)
+    start_index = (frame_index * bits_per_frame // 3) % len(binary_data)  # Overlap by 2/3 for redundancy
     
-    # Top border (excluding corners)
-    mask = np.zeros_like(bordered_frame, dtype=bool)
-    mask[0:border_width, corner_size:width-corner_size] = True
-    bordered_frame[mask] = cv2.addWeighted(bordered_frame, 1-alpha, border_overlay, alpha, 0)[mask]
+    # Calculate the corner size
+    corner_size = border_width * 2
     
-    # Right border (excluding corners)
-    mask = np.zeros_like(bordered_frame, dtype=bool)
-    mask[corner_size:height-corner_size, width-border_width:width] = True
-    bordered_frame[mask] = cv2.addWeighted(bordered_frame, 1-alpha, border_overlay, alpha, 0)[mask]
+    # KEEP EXISTING TOP-LEFT CORNER ENCODING (DON'T MODIFY THIS PART)
+    # Encode data in the top-left corner only, row by row, wrapping around
+    # the data when this frame's portion runs past its end
+    num_bits = min(bits_per_frame, corner_size * corner_size)
+    frame_bits = binary_data[(start_index + np.arange(num_bits)) % len(binary_data)]
+    rows, cols = np.divmod(np.arange(num_bits), corner_size)
+    bordered_frame[rows, cols] = _bit_colors(frame_index, total_frames)[frame_bits]
     
-    # Bottom border (excluding corners)
-    mask = np.zeros_like(bordered_frame, dtype=bool)
-    mask[height-border_width:height, corner_size:width-corner_size] = True
-    bordered_frame[mask] = cv2.addWeighted(bordered_frame, 1-alpha, border_overlay, alpha, 0)[mask]
+    corners, phases = _border_template(width, height, border_width)
+    for box, patch in corners:
+        bordered_frame[box] = patch
     
-    # Left border (excluding corners)
-    mask = np.zeros_like(bordered_frame, dtype=bool)
-    mask[corner_size:height-corner_size, 0:border_width] = True
-    bordered_frame[mask] = cv2.addWeighted(bordered_frame, 1-alpha, border_overlay, alpha, 0)[mask]
+    # ADD TRANSLUCENT DECORATIVE ELEMENTS TO THE REST OF THE BORDER
+    # This makes it look like there's data without actually encoding anything
+    alpha = 0.6  # Translucency level (0.0 to 1.0)
+    for roi, colors, mask in phases[frame_index % 8]:
+        strip = bordered_frame[roi]
+        if strip.size == 0:
+            continue
+        overlay = strip.copy()
+        np.copyto(overlay, colors, where=mask)
+        # Blend the overlay with the strip for translucent effect
+        strip[...] = cv2.addWeighted(strip, 1 - alpha, overlay, alpha, 0)
     
     return bordered_frame
 
@@ -617,41 +2222,39 @@ def create_data_corners(frame, frame_index, total_frames, border_width=20):
     
     return frame
 
-def add_data_border_to_frames(frames, data, temp_dir):
-    """Add data-encoding border to all frames"""
-    bordered_frames = []
+def _border_stage(data, total_frames, border_width, frame_index, frame):
+    """Draw the data border onto one frame in place"""
+    return create_data_border(frame, data, frame_index, total_frames, border_width, copy=False)
+
+def add_data_border_to_frames(frames, data, total_frames, workers=1, progress=None):
+    """Add data-encoding border to all frames
     
+    progress(done, total) is called along with the progress log lines.
+    """
     # Set a reasonable border width
     border_width = 20
     
-    # Get total frame count
-    total_frames = len(frames)
-    
     # Prepare the data to encode with STEGO marker
     full_data = f"STEGO:{data}"
     print(f"[INFO] Encoding data in border: {full_data[:50]}...")
     
-    # Process each frame
-    for i, frame_path in enumerate(frames):
-        # Read frame
-        frame = cv2.imread(frame_path)
-        if frame is None:
-            continue
-        
-        # Create border with encoded data in top-left corner only
-        bordered_frame = create_data_border(frame, full_data, i, total_frames, border_width)
-        
-        # Save the bordered frame
-        bordered_path = os.path.join(temp_dir, f"bordered_{i}.png")
-        cv2.imwrite(bordered_path, bordered_frame)
-        bordered_frames.append(bordered_path)
+    # Process each frame, creating the border with encoded data in the top-left corner only
+    count = 0
+    stage = functools.partial(_border_stage, full_data, total_frames, border_width)
+    for i, bordered_frame in enumerate(map_frames(stage, frames, workers)):
+        yield bordered_frame
+        count += 1
         
         # Log progress
         if i % 10 == 0:
             print(f"[INFO] Added data border to frame {i}/{total_frames}")
+            if progress is not None:
+                progress(count, total_frames)
     
-    print(f"[INFO] Added data borders to all {len(bordered_frames)} frames")
-    return bordered_frames
+    print(f"[INFO] Added data borders to all {count} frames")
+    if progress is not None:
+        progress(count, count)
+
 def detect_border_in_frame(frame):
     """Detect if a frame has our specific encoding pattern in the top-left corner"""
     # Get frame dimensions
@@ -758,70 +2361,173 @@ def decode_corner_data(frame):
         return 0, 0
 
 def decode_border_data(frame, border_width=20):
-    """Decode data from the top-left corner only, since that's where we encode it"""
+    """Decode data from the top-left corner only, since that's where we encode it
+    
+    Accepts a single frame or a stack of frames (or of their top-left
+    corners) and returns one text, or a list of texts for a stack.
+    """
+    frames = np.asarray(frame)
+    single = frames.ndim == 3
+    if single:
+        frames = frames[np.newaxis]
+    
     # Get frame dimensions
-    height, width = frame.shape[:2]
+    height, width = frames.shape[1:3]
     corner_size = border_width * 2
     
     # Make sure the frame is large enough
     if width < corner_size or height < corner_size:
-        return None
+        return None if single else [None] * len(frames)
     
     # Extract the top-left corner
-    top_left = frame[0:corner_size, 0:corner_size]
-    
-    # Function to determine if a pixel is likely a '1' bit based on color
-    def is_one_bit(pixel):
-        # Simple RGB check - typically our 1-bits are orange/red
-        # which have high red values compared to blue
-        return pixel[2] > pixel[0] + 20
+    top_left = frames[:, 0:corner_size, 0:corner_size]
     
-    # Extract bits from the top-left corner, row by row
-    extracted_bits = ""
-    for y in range(corner_size):
-        for x in range(corner_size):
-            pixel = top_left[y, x]
-            extracted_bits += '1' if is_one_bit(pixel) else '0'
+    # Our 1-bits are orange/red, which have high red values compared to blue.
+    # The comparison is done in uint8 (blue + 20 wraps) like it always was
+    bits = top_left[..., 2] > top_left[..., 0] + np.uint8(20)
+    bits = bits.reshape(len(frames), -1)
     
     # Convert binary data to text
-    print(f"[INFO] Extracted {len(extracted_bits)} bits from corner")
-    extracted_text = binary_to_text(extracted_bits)
-    return extracted_text
+    print(f"[INFO] Extracted {bits.shape[1]} bits from corner of {len(frames)} frame(s)")
+    texts = [bits_to_text(frame_bits) for frame_bits in bits]
+    return texts[0] if single else texts
 
-def extract_border_data(video_path, temp_dir):
-    """Extract data from the top-left corner of frames"""
-    # Create a temporary directory
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
-    
-    cap = cv2.VideoCapture(video_path)
-    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    
-    # Sample frames throughout the video
-    samples = min(10, frame_count)  # Use fewer samples for quicker processing
-    sample_indices = [int(i * frame_count / samples) for i in range(samples)]
-    
-    print(f"[INFO] Sampling {samples} frames to extract border data")
+def border_candidate_indices(frame_count, keyframes=None):
+    """Frames to sample for border data, best first: frame 0, keyframes spread over the video, then the even spread"""
+    order = [0]
+    if keyframes:
+        keyframes = [k for k in keyframes if k < frame_count]
+        count = min(BORDER_SAMPLES, len(keyframes))
+        order += [keyframes[int(i * len(keyframes) / count)] for i in range(count)]
+    order += border_sample_indices(frame_count)
+    return list(dict.fromkeys(i for i in order if i < frame_count))[:BORDER_SAMPLES]
+
+def _corner_bits(frame, frame_index, total_frames, border_width=20):
+    """Signed bit margins of a frame's top-left corner and the number of bits it holds
+    
+    A margin's sign is the nearer colour, '0' negative and '1' positive, and
+    its size how clearly the pixel shows it, so noisy frames weigh less in
+    the vote. Full-colour frames are read by colour; frames whose chroma was
+    subsampled blend neighbouring bits' colours and are read by luma, which
+    stays per pixel, whichever gives the clearer margins. The bits fill the
+    corner row by row and the picture shows through after them, so they end
+    where pixels stop looking like a blend of the two colours. The count is
+    0 when the bits fill all the frame can carry, since the message may then
+    be longer.
+    """
+    height, width = frame.shape[:2]
+    corner_size = border_width * 2
+    pixels = frame[:corner_size, :corner_size].reshape(-1, 3).astype(np.float32)
+    colors = _bit_colors(frame_index, total_frames).astype(np.float32)
+    
+    # Distance to the segment between the colours, along which subsampled chroma blends them
+    span_vector = colors[1] - colors[0]
+    blend = np.clip((pixels - colors[0]) @ span_vector / (span_vector @ span_vector), 0, 1)
+    distance = np.linalg.norm(pixels - (colors[0] + blend[:, None] * span_vector), axis=1)
+    
+    # End of the longest prefix with more bit-coloured pixels than others, in whole bytes
+    matched = distance < BORDER_COLOR_TOLERANCE
+    score = np.cumsum(np.where(matched, 1, -1))
+    length = int(np.argmax(score)) + 1
+    bits = int(round(length / 8)) * 8
+    capacity = min((2 * (width + height) - 4 * border_width) // 2, corner_size * corner_size)
+    
+    # By colour: 1 on a colour, 0 as far from both
+    zero_distance = np.linalg.norm(pixels - colors[0], axis=1)
+    one_distance = np.linalg.norm(pixels - colors[1], axis=1)
+    color_margins = (zero_distance - one_distance) / (zero_distance + one_distance + 1e-6)
+    # By luma: 1 on a colour's luma, 0 halfway to the other's or as far beyond
+    luma = np.array([0.114, 0.587, 0.299], dtype=np.float32)  # BT.601 weights in BGR order
+    zero_luma, one_luma = colors @ luma
+    position = (pixels @ luma - (zero_luma + one_luma) / 2) / ((one_luma - zero_luma) / 2)
+    luma_margins = np.sign(position) * np.clip(1 - np.abs(np.abs(position) - 1), 0, 1)
+    
+    clearer = np.abs(color_margins[:length]).mean() >= np.abs(luma_margins[:length]).mean()
+    margins = color_margins if clearer else luma_margins
+    return margins, bits if bits < capacity - 8 else 0
+
+def _vote_border_bits(samples, width, height, border_width=20):
+    """Majority vote per message bit over the sampled frames
+    
+    samples holds (frame index, margins, bits) of every bordered frame read so
+    far. Each frame holds the message rotated by its own offset, which is
+    undone before voting. The frames' length estimates can be a byte off, so
+    all of them vote at every estimated length and the clearest result wins.
+    Returns the text (None unless it starts with the STEGO: marker), how many
+    frames decode to it on their own, and the mean vote margin as confidence.
+    """
+    located = [(frame_index, margins) for frame_index, margins, bits in samples if bits]
+    best = (None, 0, 0.0)
+    for length in set(bits for _, _, bits in samples if bits):
+        bits_per_frame = min(length, (2 * (width + height) - 4 * border_width) // 2)
+        votes = np.zeros(length, dtype=np.float32)
+        aligned = []
+        for frame_index, margins in located:
+            # Same offset create_data_border started this frame's bits at
+            start = (frame_index * bits_per_frame // 3) % length
+            aligned.append(np.roll(margins[:length], start))
+            votes += aligned[-1]
+        
+        message = votes > 0
+        agreeing = sum(np.array_equal(frame_bits > 0, message) for frame_bits in aligned)
+        confidence = float(np.mean(np.abs(votes))) / len(aligned)
+        text = bits_to_text(message)
+        result = (text if text.startswith('STEGO:') else None), agreeing, confidence
+        if (result[0] is not None, agreeing, confidence) > (best[0] is not None, best[1], best[2]):
+            best = result
+    return best
+
+def extract_border_data(video_path, plan=None):
+    """Extract data from the top-left corner of frames
+    
+    Frame 0, keyframes spread over the video and then evenly spread frames
+    are candidates. They are read in order in one pass, and their corner
+    bits are voted on until BORDER_AGREE_FRAMES frames decode to the
+    same text or the vote is BORDER_CONFIDENCE sure, at most BORDER_SAMPLES
+    frames. Messages too long to locate in the corner fall back to the
+    longest STEGO: fragment of the sampled frames.
+    """
+    if plan is None:
+        with contextlib.closing(FramePlan(video_path)) as plan:
+            return extract_border_data(video_path, plan)
+    
+    candidates = border_candidate_indices(plan.frame_count, plan.reader.keyframes)
+    print(f"[INFO] Sampling up to {len(candidates)} frames to extract border data")
     
-    # Collect raw frame data
     raw_frames = []
-    for frame_idx in sample_indices:
-        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
-        ret, frame = cap.read()
-        if ret:
-            # Check if the frame has our border encoding
-            if detect_border_in_frame(frame):
-                raw_frames.append((frame_idx, frame))
-    
-    cap.release()
-    
+    samples = []
+    text = None
+    frames = plan.iter_frames(candidates)
+    for frame_idx, frame in frames:
+        # Check if the frame has our border encoding
+        if not detect_border_in_frame(frame):
+            continue
+        raw_frames.append((frame_idx, frame))
+        margins, bits = _corner_bits(frame, frame_idx, plan.frame_count)
+        samples.append((frame_idx, margins, bits))
+        
+        text, agreeing, confidence = _vote_border_bits(samples, frame.shape[1], frame.shape[0])
+        if text and (agreeing >= BORDER_AGREE_FRAMES or confidence >= BORDER_CONFIDENCE):
+            print(f"[INFO] Border data settled after {len(raw_frames)} frames "
+                  f"({agreeing} agreeing, confidence {confidence:.2f})")
+            frames.close()
+            return text
+    
+    if text:
+        return text
     if not raw_frames:
         return "No frames with border encoding found"
+    return longest_border_fragment(raw_frames)
+
+def longest_border_fragment(raw_frames):
+    """Best guess at the border text from (index, frame) pairs: the longest STEGO: fragment"""
+    # Extract texts from all sampled corners at once
+    corner_size = 20 * 2
+    corners = np.stack([frame[0:corner_size, 0:corner_size] for _, frame in raw_frames])
+    texts = decode_border_data(corners)
     
-    # Extract texts from each frame
     frame_texts = []
-    for idx, frame in raw_frames:
-        text = decode_border_data(frame)
+    for (idx, _), text in zip(raw_frames, texts):
         if text:
             frame_texts.append((idx, text))
             print(f"[INFO] Frame {idx}: {text[:30]}...")
@@ -854,146 +2560,1299 @@ def extract_border_data(video_path, temp_dir):
 
 
 # API endpoints
-@app.route('/encrypt', methods=['POST'])
-def encrypt_endpoint():
-    """Endpoint to encrypt text and hide it in video"""
-    if 'video' not in request.files or 'text' not in request.form:
-        return jsonify({"error": "Missing video file or text"}), 400
+def wants_binary_response():
+    """Whether the client asked for the raw video instead of base64 JSON"""
+    if request.args.get('response') == 'binary':
+        return True
+    # JSON stays the default, including for "*/*"
+    best = request.accept_mimetypes.best_match(['application/json', 'video/*', 'application/octet-stream'])
+    return best not in (None, 'application/json')
+
+def stream_file_response(path, chunk_size=STREAM_CHUNK_SIZE, download_name=None):
+    """Stream a file from disk in chunks with Content-Length, honouring a single byte Range
+    
+    Unlike send_file this also serves ranges for POST requests, whose
+    response is the only copy of the freshly encoded video.
+    """
+    # Open the file up front so the response survives the path being removed
+    file_obj = open(path, 'rb')
+    size = os.fstat(file_obj.fileno()).st_size
+    start, stop, status = 0, size, 200
+    # Multiple ranges are answered with the whole file instead of a multipart body
+    if request.range is not None and len(request.range.ranges) == 1:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            file_obj.close()
+            response = Response(status=416)
+            response.headers['Content-Range'] = f"bytes */{size}"
+            return response
+        (start, stop), status = byte_range, 206
+    
+    def generate():
+        with file_obj:
+            file_obj.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = file_obj.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+    
+    response = Response(generate(), status=status,
+                        mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+    response.call_on_close(file_obj.close)
+    response.headers['Content-Length'] = str(stop - start)
+    response.headers['Accept-Ranges'] = 'bytes'
+    if status == 206:
+        response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name or os.path.basename(path))
+    response.headers['Access-Control-Expose-Headers'] = 'Content-Disposition, Content-Length, Content-Range, Accept-Ranges'
+    return response
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only, unseekable stream collecting what zipfile writes"""
     
-    video_file = request.files['video']
-    text = request.form['text']
+    def __init__(self):
+        self.chunks = []
     
-    if video_file.filename == '':
-        return jsonify({"error": "No video selected"}), 400
+    def writable(self):
+        return True
     
-    # Create temporary directory for processing
-    session_id = str(uuid.uuid4())
-    temp_dir = os.path.join(TEMP_FOLDER, session_id)
-    os.makedirs(temp_dir, exist_ok=True)
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
     
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def stream_zip_response(entries, download_name, chunk_size=STREAM_CHUNK_SIZE):
+    """Stream a zip archive of entries, a list of (name, path or bytes), without building it on disk
+    
+    Files are stored uncompressed, since the videos are compressed already.
+    """
+    def generate():
+        sink = _ChunkSink()
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for name, source in entries:
+                info = zipfile.ZipInfo(name, time.localtime()[:6])
+                if isinstance(source, bytes):
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    archive.writestr(info, source)
+                    yield sink.drain()
+                    continue
+                with open(source, 'rb') as file_obj, archive.open(info, 'w', force_zip64=True) as member:
+                    while True:
+                        chunk = file_obj.read(chunk_size)
+                        if not chunk:
+                            break
+                        member.write(chunk)
+                        yield sink.drain()
+        yield sink.drain()
+    
+    response = Response(generate(), mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    response.headers['Access-Control-Expose-Headers'] = 'Content-Disposition'
+    return response
+
+def remove_temp_dir(temp_dir):
+    """Delete a request's temporary directory"""
     try:
-        # Save uploaded video
-        video_path = os.path.join(temp_dir, secure_filename(video_file.filename))
-        video_file.save(video_path)
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+    except Exception as cleanup_error:
+        print(f"Error cleaning up: {cleanup_error}")
+
+# Scratch workspace
+# Every request works in a session directory under TEMP_FOLDER, and every
+# job in one under JOBS_FOLDER. Sessions reserve room against
+# WORKSPACE_QUOTA_BYTES before the upload is read and wait up to
+# WORKSPACE_WAIT seconds for space, then get 503. A session's reservation is
+# a file in its own directory, so all worker processes sharing the folders
+# count the same sessions (under a file lock) and a reservation ends with
+# its directory. Finished sessions are deleted by a background thread once
+# the response has gone out, and directories left behind by crashed workers
+# are swept by age
+WORKSPACE_QUOTA_BYTES = int(os.environ.get('WORKSPACE_QUOTA_BYTES', 8 * 1024 ** 3))  # 0 disables the quota
+WORKSPACE_EXPANSION = 4  # scratch bytes reserved per uploaded byte: upload, mov and mp4 outputs
+WORKSPACE_WAIT = float(os.environ.get('WORKSPACE_WAIT', 10))  # seconds a request waits for room
+WORKSPACE_ORPHAN_AGE = int(os.environ.get('WORKSPACE_ORPHAN_AGE', 6 * 3600))  # seconds untouched before a session is swept
+WORKSPACE_SWEEP_INTERVAL = 600  # seconds between sweeps
+WORKSPACE_RETRY_AFTER = 30  # seconds suggested to clients turned away for lack of space
+WORKSPACE_RESERVATION = '.reserved'  # file in a session directory holding its reserved bytes
+WORKSPACE_LOCK = '.lock'  # file in the root that serialises reservations across processes
+
+class WorkspaceFull(Exception):
+    """No scratch space could be reserved in time"""
+
+class Session:
+    """A request's scratch directory and the bytes reserved for it"""
+    
+    def __init__(self, path, reserved):
+        self.path = path
+        self.reserved = reserved
+
+def _newest_mtime(path):
+    """Latest modification time of a directory or anything inside it"""
+    newest = os.stat(path).st_mtime
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                newest = max(newest, os.stat(os.path.join(directory, name)).st_mtime)
+            except FileNotFoundError:
+                pass
+    return newest
+
+class Workspace:
+    """Hands out session directories under root, and any added folder, within a byte quota
+    
+    Deletion and the orphan sweep run on background threads, started lazily
+    in each process since threads do not survive gunicorn forking the
+    preloaded app.
+    """
+    
+    def __init__(self, root, quota, wait, orphan_age):
+        self.root = root
+        self.quota = quota
+        self.wait = wait
+        self.folders = {root: orphan_age}  # folder -> seconds untouched before its sessions are swept
+        self._cond = threading.Condition()
+        self._pid = None
+        os.makedirs(root, exist_ok=True)
+    
+    def add_folder(self, folder, orphan_age):
+        """Manage sessions in another folder too, counted against the same quota"""
+        os.makedirs(folder, exist_ok=True)
+        self.folders[folder] = orphan_age
+    
+    def _start(self):
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._active = set()
+            self._trash = queue.Queue()
+        threading.Thread(target=self._delete_worker, name='workspace-delete', daemon=True).start()
+        threading.Thread(target=self._sweep_worker, name='workspace-sweep', daemon=True).start()
+    
+    @contextlib.contextmanager
+    def _ledger(self):
+        """Hold the lock all processes take to read and add reservations"""
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.root, WORKSPACE_LOCK), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    def reserved(self):
+        """Bytes reserved by the sessions of every process"""
+        total = 0
+        for folder in self.folders:
+            for entry in os.scandir(folder):
+                try:
+                    with open(os.path.join(entry.path, WORKSPACE_RESERVATION)) as reservation:
+                        total += int(reservation.read() or 0)
+                except (OSError, ValueError):
+                    pass  # Not a session, or deleted meanwhile
+        return total
+    
+    def _fits(self, size):
+        if self.quota and self.reserved() + size > self.quota:
+            return False
+        return shutil.disk_usage(self.root).free >= size
+    
+    def session(self, expected_bytes=None, folder=None):
+        """Create a session directory in folder (the root by default) with room for an upload of expected_bytes
+        
+        Raises WorkspaceFull if the space is not available within self.wait seconds.
+        """
+        self._start()
+        folder = folder or self.root
+        size = (expected_bytes or MAX_UPLOAD_BYTES) * WORKSPACE_EXPANSION
+        if self.quota:
+            size = min(size, self.quota)
+        deadline = time.monotonic() + self.wait
+        path = os.path.join(folder, uuid.uuid4().hex)
+        with self._cond:
+            while True:
+                with self._ledger():
+                    if self._fits(size):
+                        os.makedirs(path)
+                        with open(os.path.join(path, WORKSPACE_RESERVATION), 'w') as reservation:
+                            reservation.write(str(size))
+                        self._active.add(path)
+                        return Session(path, size)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise WorkspaceFull("Not enough scratch space, try again later")
+                # Other processes free space without notifying, so check again periodically
+                self._cond.wait(min(remaining, 1.0))
+    
+    def release(self, session):
+        """Delete a session in the background; its reservation ends once the files are gone"""
+        self.discard(session.path)
+    
+    def discard(self, path):
+        """Delete any directory in the background"""
+        self._start()
+        self._trash.put(path)
+    
+    def _delete_worker(self):
+        while True:
+            path = self._trash.get()
+            # The reservation goes last, so the space stays counted while the files are deleted
+            try:
+                for entry in os.scandir(path):
+                    if entry.name == WORKSPACE_RESERVATION:
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.remove(entry.path)
+            except OSError as e:
+                if not isinstance(e, FileNotFoundError):
+                    print(f"Error cleaning up: {e}")
+            remove_temp_dir(path)
+            with self._cond:
+                self._active.discard(path)
+                self._cond.notify_all()
+    
+    def sweep(self):
+        """Delete session directories nothing has written to for their folder's orphan age"""
+        now = time.time()
+        with self._cond:
+            active = set(self._active)
+        for folder, orphan_age in self.folders.items():
+            for name in os.listdir(folder):
+                path = os.path.join(folder, name)
+                if path in active or not os.path.isdir(path):
+                    continue
+                try:
+                    age = now - _newest_mtime(path)
+                except FileNotFoundError:
+                    continue  # Deleted meanwhile, e.g. by another worker
+                if age > orphan_age:
+                    print(f"[INFO] Removing orphaned workspace {name}, untouched for {age / 3600:.1f} h")
+                    self.discard(path)
+    
+    def _sweep_worker(self):
+        # The first sweep runs at startup
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"[ERROR] Workspace sweep failed: {e}")
+            time.sleep(WORKSPACE_SWEEP_INTERVAL)
+
+WORKSPACE_REJECTED = Counter('truthcast_workspace_rejected_total', 'Requests turned away for lack of scratch space', ('endpoint',))
+
+workspace = Workspace(TEMP_FOLDER, WORKSPACE_QUOTA_BYTES, WORKSPACE_WAIT, WORKSPACE_ORPHAN_AGE)
+
+# Result cache
+# Finished /encrypt outputs are kept on disk under the SHA-256 of the upload
+# and the request options, so retried and resubmitted requests skip the
+# pipeline. Entries are evicted least recently used once RESULT_CACHE_BYTES
+# is exceeded, and identical requests in flight share one computation.
+# Worker processes sharing the folder each keep their own index and pick up
+# entries stored by the others
+RESULT_CACHE_FOLDER = os.environ.get('RESULT_CACHE_FOLDER', './cache/encrypt')
+RESULT_CACHE_BYTES = int(os.environ.get('RESULT_CACHE_BYTES', 2 * 1024 ** 3))  # 0 disables the cache
+RESULT_CACHE_META = 'meta.json'
+
+class ResultCache:
+    """LRU cache of result directories, bounded by their total size on disk"""
+    
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()  # key -> size in bytes, least recently used first
+        self._inflight = {}
+        self._lock = threading.Lock()
+        if max_bytes > 0:
+            os.makedirs(folder, exist_ok=True)
+            self._load()
+    
+    def _load(self):
+        """Index the entries left by earlier runs, oldest access first"""
+        entries = []
+        for name in os.listdir(self.folder):
+            entry_dir = os.path.join(self.folder, name)
+            if name.startswith('.'):
+                remove_temp_dir(entry_dir)  # Unfinished build
+            elif os.path.isfile(os.path.join(entry_dir, RESULT_CACHE_META)):
+                entries.append((os.path.getmtime(entry_dir), name, self._dir_size(entry_dir)))
+        for _, name, size in sorted(entries):
+            self._entries[name] = size
+        print(f"[INFO] Result cache holds {len(entries)} entries")
+    
+    @staticmethod
+    def _dir_size(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    
+    def _read(self, key):
+        entry_dir = os.path.join(self.folder, key)
+        with open(os.path.join(entry_dir, RESULT_CACHE_META)) as meta_file:
+            meta = json.load(meta_file)
+        meta["files"] = {fmt: os.path.join(entry_dir, name) for fmt, name in meta["files"].items()}
+        return meta
+    
+    def get_or_create(self, key, build, scratch_dir):
+        """Return (result, cached) for key, calling build(directory) on a miss
+        
+        build writes its files into the directory and returns a JSON-able
+        dict with a "files" mapping of names relative to it. With the cache
+        disabled the files are built in scratch_dir instead.
+        """
+        if self.max_bytes <= 0:
+            meta = build(scratch_dir)
+            meta["files"] = {fmt: os.path.join(scratch_dir, name) for fmt, name in meta["files"].items()}
+            return meta, False
+        
+        entry_dir = os.path.join(self.folder, key)
+        with self._lock:
+            if key not in self._entries and os.path.isfile(os.path.join(entry_dir, RESULT_CACHE_META)):
+                # Built by another worker process sharing the folder
+                self._entries[key] = self._dir_size(entry_dir)
+            if key in self._entries:
+                try:
+                    os.utime(entry_dir)
+                    result = self._read(key)
+                except FileNotFoundError:
+                    # Evicted by another worker process
+                    del self._entries[key]
+                else:
+                    self._entries.move_to_end(key)
+                    CACHE_LOOKUPS.inc(cache='encrypt', result='hit')
+                    return result, True
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        
+        if not leader:
+            # Same request already running, wait for its result
+            future.result()
+            CACHE_LOOKUPS.inc(cache='encrypt', result='shared')
+            return self._read(key), True
+        CACHE_LOOKUPS.inc(cache='encrypt', result='miss')
+        
+        build_dir = os.path.join(self.folder, f".{key}-{uuid.uuid4().hex}")
+        try:
+            os.makedirs(build_dir)
+            meta = build(build_dir)
+            with open(os.path.join(build_dir, RESULT_CACHE_META), 'w') as meta_file:
+                json.dump(meta, meta_file)
+            try:
+                os.replace(build_dir, entry_dir)
+            except OSError:
+                # Another worker process stored the same entry first
+                remove_temp_dir(build_dir)
+            with self._lock:
+                self._entries[key] = self._dir_size(entry_dir)
+                evicted = self._evict()
+            for name in evicted:
+                remove_temp_dir(os.path.join(self.folder, name))
+            future.set_result(True)
+        except BaseException as e:
+            remove_temp_dir(build_dir)
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+        return self._read(key), False
+    
+    def _evict(self):
+        """Drop least recently used entries until the budget is met, keeping the newest"""
+        evicted = []
+        total = sum(self._entries.values())
+        while total > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            evicted.append(name)
+            total -= size
+        if evicted:
+            print(f"[INFO] Evicted {len(evicted)} result cache entries")
+        return evicted
+
+result_cache = ResultCache(RESULT_CACHE_FOLDER, RESULT_CACHE_BYTES)
+
+# Decode cache
+# /decrypt results keyed by the SHA-256 of the uploaded video, kept in memory
+# and as small JSON files on disk. Entries expire after DECRYPT_CACHE_TTL and
+# are ignored once the set of keys in the keyring changes
+DECRYPT_CACHE_FOLDER = os.environ.get('DECRYPT_CACHE_FOLDER', './cache/decrypt')
+DECRYPT_CACHE_TTL = int(os.environ.get('DECRYPT_CACHE_TTL', 24 * 3600))  # seconds, 0 disables the cache
+DECRYPT_CACHE_ENTRIES = int(os.environ.get('DECRYPT_CACHE_ENTRIES', 1024))  # kept in memory
+DECRYPT_CACHE_FILES = int(os.environ.get('DECRYPT_CACHE_FILES', 100000))  # kept on disk
+DECRYPT_CACHE_PRUNE_INTERVAL = 256  # puts between scans of the folder for files over the limit
+
+class DecodeCache:
+    """Two-level cache from video digest to decode result"""
+    
+    def __init__(self, folder, ttl, max_entries, max_files):
+        self.folder = folder
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_files = max_files
+        self._memory = collections.OrderedDict()  # digest -> (stored_at, key fingerprint, result)
+        self._lock = threading.Lock()
+        self._puts = 0
+        if ttl > 0:
+            os.makedirs(folder, exist_ok=True)
+    
+    def _path(self, digest):
+        return os.path.join(self.folder, f"{digest}.json")
+    
+    def _valid(self, stored_at, fingerprint):
+        return time.time() - stored_at < self.ttl and fingerprint == keyring.fingerprint
+    
+    def get(self, digest):
+        """Return the cached result for a video digest, or None"""
+        if self.ttl <= 0:
+            return None
+        keyring.refresh()
+        with self._lock:
+            entry = self._memory.get(digest)
+            if entry is not None:
+                if self._valid(entry[0], entry[1]):
+                    self._memory.move_to_end(digest)
+                    return entry[2]
+                del self._memory[digest]
+        
+        try:
+            with open(self._path(digest)) as cache_file:
+                entry = json.load(cache_file)
+        except (FileNotFoundError, ValueError):
+            return None
+        if not self._valid(entry["stored_at"], entry["fingerprint"]):
+            self._remove(digest)
+            return None
+        self._remember(digest, (entry["stored_at"], entry["fingerprint"], entry["result"]))
+        return entry["result"]
+    
+    def put(self, digest, result):
+        """Store the decode result of a video"""
+        if self.ttl <= 0:
+            return
+        entry = (time.time(), keyring.fingerprint, result)
+        self._remember(digest, entry)
         
-        # Extract frames from video FIRST
-        frames, _ = extract_frames(video_path, temp_dir)
+        # Write through a temporary file so readers never see a partial entry
+        path = self._path(digest)
+        with open(f"{path}.{uuid.uuid4().hex}.tmp", 'w') as cache_file:
+            json.dump({"stored_at": entry[0], "fingerprint": entry[1], "result": result}, cache_file)
+        os.replace(cache_file.name, path)
         
-        # Add data-encoding borders BEFORE steganography
-        frames = add_data_border_to_frames(frames, text, temp_dir)
+        # Scanning the folder costs as much as it holds, so it only happens every few puts
+        with self._lock:
+            self._puts += 1
+            prune = self._puts % DECRYPT_CACHE_PRUNE_INTERVAL == 1
+        if prune:
+            self._prune()
+    
+    def _remember(self, digest, entry):
+        with self._lock:
+            self._memory[digest] = entry
+            self._memory.move_to_end(digest)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+    
+    def _remove(self, digest):
+        try:
+            os.remove(self._path(digest))
+        except FileNotFoundError:
+            pass
+    
+    def _prune(self):
+        """Delete the oldest files once there are more than max_files
         
-        # Encrypt the text using RSA AFTER borders
+        Between prunes each process can add up to DECRYPT_CACHE_PRUNE_INTERVAL files more.
+        """
+        files = [entry for entry in os.scandir(self.folder) if entry.name.endswith('.json')]
+        if len(files) <= self.max_files:
+            return
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in files[:len(files) - self.max_files]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+decode_cache = DecodeCache(DECRYPT_CACHE_FOLDER, DECRYPT_CACHE_TTL, DECRYPT_CACHE_ENTRIES, DECRYPT_CACHE_FILES)
+
+class InvalidRequest(Exception):
+    """A client error, rendered as a JSON error response"""
+    
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+@app.errorhandler(InvalidRequest)
+def handle_invalid_request(error):
+    return jsonify({"error": str(error)}), error.status
+
+@app.errorhandler(WorkspaceFull)
+def handle_workspace_full(error):
+    WORKSPACE_REJECTED.inc(endpoint=request.endpoint)
+    response = jsonify({"error": str(error)})
+    response.headers['Retry-After'] = str(WORKSPACE_RETRY_AFTER)
+    return response, 503
+
+def parse_encode_options(fields):
+    """Read the frame-worker, output-format and mode options of an encode request
+    
+    Options may come from the upload's form fields or the query string.
+    """
+    def option(name, default):
+        return fields.get(name, request.args.get(name, default))
+    
+    # Per-request parallelism of the frame stages, capped by the server setting
+    try:
+        workers = int(option('workers', FRAME_WORKERS))
+    except ValueError:
+        raise InvalidRequest("workers must be an integer")
+    workers = max(1, min(workers, MAX_FRAME_WORKERS))
+    
+    # Output profiles to produce, e.g. "mp4", "mov,mp4" or "lossless"
+    formats = [fmt.strip().lower() for fmt in option('formats', 'mp4').split(',') if fmt.strip()]
+    unknown = [fmt for fmt in formats if fmt not in OUTPUT_PROFILES]
+    if not formats or unknown:
+        raise InvalidRequest(f"Unsupported output formats: {', '.join(unknown) or 'none'}")
+    
+    # "sparse" re-encodes only the GOPs holding the payload
+    mode = option('mode', 'full').strip().lower()
+    if mode not in ENCODE_MODES:
+        raise InvalidRequest(f"Unsupported mode: {mode}")
+    if mode == 'sparse' and formats != ['mp4']:
+        raise InvalidRequest("Sparse mode only produces mp4")
+    return workers, formats, mode
+
+# Uploads
+# Multipart bodies are parsed straight off the request stream, so the video
+# is written once, in chunks, to the session's scratch file and hashed on the
+# way. Bodies over MAX_UPLOAD_BYTES and files that do not start like a known
+# video container are rejected before the rest of the body is read
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 1024 ** 3))
+MAX_FORM_FIELD_BYTES = 1024 * 1024  # per text field
+UPLOAD_PROBE_BYTES = 512  # bytes of the file looked at to recognise the container
+
+def detect_container(head):
+    """Name of the video container a file starts like, or None"""
+    if head[4:8] == b'ftyp':
+        return 'mp4'  # MP4, MOV, 3GP, M4V
+    if head[4:8] in (b'moov', b'mdat', b'wide', b'free', b'skip'):
+        return 'mov'  # QuickTime files without an ftyp box
+    if head.startswith(b'\x1a\x45\xdf\xa3'):
+        return 'matroska'  # MKV, WebM
+    if head[:4] == b'RIFF' and head[8:12] == b'AVI ':
+        return 'avi'
+    if head.startswith(b'FLV'):
+        return 'flv'
+    if head.startswith(b'\x00\x00\x01\xba'):
+        return 'mpeg-ps'
+    if head[:1] == b'\x47' and head[188:189] == b'\x47':
+        return 'mpeg-ts'
+    return None
+
+class Upload:
+    """The video and the text fields of a multipart upload"""
+    
+    def __init__(self):
+        self.fields = {}
+        self.filename = None
+        self.path = None
+        self.size = 0
+        self.container = None
+        self.digest = hashlib.sha256()
+
+def receive_upload(directory, file_field='video'):
+    """Stream a multipart upload into directory, returning an Upload
+    
+    Raises InvalidRequest (400, 413 or 415) as soon as the body is known to
+    be unacceptable.
+    """
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        raise InvalidRequest("Expected a multipart/form-data upload")
+    if request.content_length is not None and request.content_length > MAX_UPLOAD_BYTES + MAX_FORM_FIELD_BYTES:
+        raise InvalidRequest(f"Upload is larger than {MAX_UPLOAD_BYTES} bytes", 413)
+    
+    upload = Upload()
+    decoder = MultipartDecoder(boundary.encode('latin-1'))
+    current = None  # field being received, file_field for the video
+    field_data = bytearray()
+    head = b''
+    output_file = None
+    
+    def check_container(head):
+        upload.container = detect_container(head)
+        if upload.container is None:
+            raise InvalidRequest("Uploaded file is not a supported video", 415)
+        print(f"[INFO] Receiving {upload.container} upload {upload.filename}")
+    
+    try:
+        with span('upload_save'):
+            complete = False
+            while not complete:
+                chunk = request.stream.read(STREAM_CHUNK_SIZE)
+                decoder.receive_data(chunk or None)
+                event = decoder.next_event()
+                while event is not NEED_DATA and not complete:
+                    if isinstance(event, File) and event.name == file_field and output_file is None:
+                        upload.filename = secure_filename(event.filename or '')
+                        if not upload.filename:
+                            raise InvalidRequest("No video selected")
+                        upload.path = os.path.join(directory, upload.filename)
+                        output_file = open(upload.path, 'wb')
+                        current = file_field
+                    elif isinstance(event, (Field, File)):
+                        # Other files are skipped, text fields kept
+                        current = event.name if isinstance(event, Field) else None
+                        field_data = bytearray()
+                    elif isinstance(event, Data) and current == file_field:
+                        upload.size += len(event.data)
+                        if upload.size > MAX_UPLOAD_BYTES:
+                            raise InvalidRequest(f"Upload is larger than {MAX_UPLOAD_BYTES} bytes", 413)
+                        if upload.container is None:
+                            head += event.data[:UPLOAD_PROBE_BYTES]
+                            if len(head) >= UPLOAD_PROBE_BYTES or not event.more_data:
+                                check_container(head)
+                        upload.digest.update(event.data)
+                        output_file.write(event.data)
+                        if not event.more_data:
+                            current = None
+                    elif isinstance(event, Data) and current is not None:
+                        field_data += event.data
+                        if len(field_data) > MAX_FORM_FIELD_BYTES:
+                            raise InvalidRequest(f"Field {current} is larger than {MAX_FORM_FIELD_BYTES} bytes", 413)
+                        if not event.more_data:
+                            upload.fields[current] = field_data.decode('utf-8', errors='replace')
+                            current = None
+                    elif isinstance(event, Epilogue):
+                        complete = True
+                    if not complete:
+                        event = decoder.next_event()
+                if not chunk and not complete:
+                    raise InvalidRequest("Upload ended before the multipart body was complete")
+    except ValueError as e:
+        # Malformed multipart data
+        raise InvalidRequest(f"Invalid upload: {e}")
+    finally:
+        if output_file is not None:
+            output_file.close()
+    
+    if upload.path is None:
+        raise InvalidRequest("Missing video file")
+    if upload.container is None:
+        check_container(head)
+    return upload
+
+def encrypt_video_file(video_path, text, output_path, workers=1, formats=('mp4',), progress=None, mode='full'):
+    """Encrypt text and hide it in a saved video
+    
+    Returns ({format: path}, stats) where stats holds the frame counts.
+    """
+    # Encrypt the text using RSA before streaming the frames
+    if progress is not None:
+        progress('encrypting', None, None)
+    with span('rsa'):
         encrypted_text = encrypt_rsa(text)
+    
+    # Sparse mode stream-copies the GOPs without payload frames where the source allows it
+    encoded = None
+    if mode == 'sparse':
+        encoded = encode_video_sparse(video_path, text, encrypted_text, output_path, progress)
+    
+    # Decode, border, LSB-encode and write every requested container in a single pass
+    if encoded is None:
+        encoded = encode_video(video_path, text, encrypted_text, output_path, workers, formats, progress)
+    output_paths, total_frames = encoded
+    stats = {
+        "total_frames": total_frames,
+        "payload_frames": min(len(split_string(encrypted_text)), total_frames),
+    }
+    return output_paths, stats
+
+def decrypt_video_file(video_path, progress=None):
+    """Recover the border data and the hidden text from a saved video
+    
+    Returns a dict with "border_data" and/or "stego_data", empty if nothing was found.
+    """
+    def report(stage, done=None, total=None):
+        if progress is not None:
+            progress(stage, done, total)
+    
+    # Read every frame the decode stages need through one capture
+    plan = plan_decode(video_path, functools.partial(report, 'reading frames'))
+    try:
+        # First try to extract data from borders
+        report('border sampling')
+        with span('border_sampling'):
+            border_data = extract_border_data(video_path, plan)
+        
+        # Then try to decode and decrypt hidden text
+        report('lsb reveal')
+        with span('lsb_reveal'):
+            decrypted_text = decode_video(video_path, plan, border_data)
+    finally:
+        plan.close()
+    
+    response_data = {}
+    
+    if border_data:
+        response_data["border_data"] = border_data
+    
+    if decrypted_text:
+        response_data["stego_data"] = decrypted_text
+    
+    return response_data
+
+def output_base_path(temp_dir, filename):
+    """Output path (without extension) for the encoded versions of an upload"""
+    original_filename = secure_filename(filename)
+    return os.path.join(temp_dir, f"encoded_{original_filename.rsplit('.', 1)[0]}")
+
+# Admission control
+# Every encode or decode keeps a CPU busy for seconds, so each process runs at
+# most MAX_CONCURRENT_WORK of them at once and turns further requests away
+# with 429 instead of queueing them behind the busy ones. Queued jobs take
+# the same slots, waiting for one before they start
+MAX_CONCURRENT_WORK = int(os.environ.get('MAX_CONCURRENT_WORK', 2))
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 5))  # seconds suggested to clients
+_admission = threading.BoundedSemaphore(MAX_CONCURRENT_WORK)
+_in_flight = [0]
+_in_flight_lock = threading.Lock()
+ADMISSION_REJECTED = Counter('truthcast_admission_rejected_total', 'Requests turned away because the server was saturated', ('endpoint',))
+
+@contextlib.contextmanager
+def _work_slot():
+    """Count the work holding an acquired slot as in flight, releasing the slot after it"""
+    with _in_flight_lock:
+        _in_flight[0] += 1
+    try:
+        yield
+    finally:
+        with _in_flight_lock:
+            _in_flight[0] -= 1
+        _admission.release()
+
+def admission_controlled(view):
+    """Run the view only if a work slot is free, answering 429 otherwise"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not _admission.acquire(blocking=False):
+            ADMISSION_REJECTED.inc(endpoint=request.endpoint)
+            response = jsonify({"error": "Server busy, try again later"})
+            response.headers['Retry-After'] = str(ADMISSION_RETRY_AFTER)
+            return response, 429
+        with _work_slot():
+            return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/encrypt', methods=['POST'])
+@admission_controlled
+def encrypt_endpoint():
+    """Endpoint to encrypt text and hide it in video"""
+    # Create temporary directory for processing
+    session = workspace.session(request.content_length)
+    temp_dir = session.path
+    cleanup_deferred = False
+    
+    try:
+        # Save uploaded video, hashing it on the way
+        upload = receive_upload(temp_dir)
+        if 'text' not in upload.fields:
+            return jsonify({"error": "Missing video file or text"}), 400
+        text = upload.fields['text']
+        workers, formats, mode = parse_encode_options(upload.fields)
         
-        # Encode encrypted text into frames LAST
-        frame_numbers = encode_frames(frames, encrypted_text, temp_dir)
+        # Stream the video back as a file instead of base64 JSON when asked to
+        binary_response = wants_binary_response()
+        if binary_response and len(formats) != 1:
+            return jsonify({"error": "A binary response carries exactly one output format"}), 400
         
-        # Create output video with .mov extension
-        original_filename = secure_filename(video_file.filename)
-        output_filename = f"encoded_{original_filename.rsplit('.', 1)[0]}.mov"
-        output_path = os.path.join(temp_dir, output_filename)
-        create_output_video(frames, video_path, output_path)
+        # The cache key covers the video and everything else that shapes the output
+        kid, _ = keyring.active()
+        digest = hashlib.sha256()
+        for part in (text.encode('utf-8'), ','.join(sorted(formats)).encode('ascii'), mode.encode('ascii'),
+                     kid, upload.digest.digest()):
+            digest.update(struct.pack('>I', len(part)) + part)
         
-        # Convert MOV to MP4
-        mp4_path = convert_to_mp4(output_path, temp_dir)
+        def build(directory):
+            output_paths, stats = encrypt_video_file(upload.path, text, output_base_path(directory, upload.filename),
+                                                     workers, formats, mode=mode)
+            return {"files": {fmt: os.path.basename(path) for fmt, path in output_paths.items()}, **stats}
         
-        # Check if MP4 conversion was successful
-        if not mp4_path or not os.path.exists(mp4_path):
-            return jsonify({"error": "MP4 conversion failed"}), 500
+        result, cached = result_cache.get_or_create(digest.hexdigest(), build, temp_dir)
+        print(f"[INFO] Result cache {'hit' if cached else 'miss'} for {digest.hexdigest()[:16]}")
         
-        # Read both files into memory
-        with open(output_path, 'rb') as mov_file:
-            mov_data = mov_file.read()
+        # Name the outputs after the uploaded file, whoever first produced them
+        output_name = os.path.basename(output_base_path('', upload.filename))
+        filenames = {fmt: output_name + output_suffix(fmt) for fmt in result["files"]}
         
-        with open(mp4_path, 'rb') as mp4_file:
-            mp4_data = mp4_file.read()
+        if binary_response:
+            fmt = formats[0]
+            response = stream_file_response(result["files"][fmt], download_name=filenames[fmt])
+            response.headers['X-Total-Frames'] = str(result["total_frames"])
+            response.headers['X-Payload-Frames'] = str(result["payload_frames"])
+            response.headers['X-Cache'] = 'HIT' if cached else 'MISS'
+            response.headers['Access-Control-Expose-Headers'] += ', X-Total-Frames, X-Payload-Frames, X-Cache'
+            
+            # The file is streamed after this function returns, remove it once the body is sent
+            response.call_on_close(lambda: workspace.release(session))
+            cleanup_deferred = True
+            return response
         
-        # Create response with both files
-        response = {
-            # "mov": base64.b64encode(mov_data).decode('utf-8'),
-            "mp4": base64.b64encode(mp4_data).decode('utf-8'),
-            # "mov_filename": output_filename,
-            "mp4_filename": os.path.basename(mp4_path)
-        }
+        # Create response with the encoded files
+        with span('response'):
+            response = {"cached": cached}
+            for fmt, path in result["files"].items():
+                with open(path, 'rb') as output_file:
+                    response[fmt] = base64.b64encode(output_file.read()).decode('utf-8')
+                response[f"{fmt}_filename"] = filenames[fmt]
+            response = jsonify(response)
         
-        return jsonify(response)
+        return response, {'X-Cache': 'HIT' if cached else 'MISS'}
+    
+    except InvalidRequest:
+        raise
+    
+    except FFmpegError as e:
+        return jsonify({"error": "Video encoding failed", "details": str(e)}), 500
     
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     
     finally:
-        # Clean up temporary files after response is sent
-        # We'll add a delay or move this to a background task in production
-        try:
-            if os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir)
-        except Exception as cleanup_error:
-            print(f"Error cleaning up: {cleanup_error}")
+        # Clean up temporary files unless a streamed response still needs them
+        if not cleanup_deferred:
+            workspace.release(session)
+
 @app.route('/decrypt', methods=['POST'])
+@admission_controlled
 def decrypt_endpoint():
     """Endpoint to decrypt hidden text from video"""
-    if 'video' not in request.files:
-        return jsonify({"error": "Missing video file"}), 400
-    
-    video_file = request.files['video']
-    
-    if video_file.filename == '':
-        return jsonify({"error": "No video selected"}), 400
-    
     # Create temporary directory for processing
-    session_id = str(uuid.uuid4())
-    temp_dir = os.path.join(TEMP_FOLDER, session_id)
-    os.makedirs(temp_dir, exist_ok=True)
+    session = workspace.session(request.content_length)
+    temp_dir = session.path
     
     try:
-        # Save uploaded video
-        video_path = os.path.join(temp_dir, secure_filename(video_file.filename))
-        video_file.save(video_path)
-        
-        # First try to extract data from borders
-        border_data = extract_border_data(video_path, temp_dir)
+        # Save uploaded video, hashing it for the decode cache
+        upload = receive_upload(temp_dir)
         
-        # Then try to decode and decrypt hidden text
-        decrypted_text = decode_video(video_path, temp_dir)
+        # A cached result skips both the frame decode and the RSA operation
+        response_data = decode_cache.get(upload.digest.hexdigest())
+        cached = response_data is not None
+        CACHE_LOOKUPS.inc(cache='decrypt', result='hit' if cached else 'miss')
+        if not cached:
+            response_data = decrypt_video_file(upload.path)
+            decode_cache.put(upload.digest.hexdigest(), response_data)
+        headers = {'X-Cache': 'HIT' if cached else 'MISS'}
         
-        response_data = {}
+        if response_data:
+            return jsonify(response_data), headers
+        else:
+            return jsonify({"error": "No hidden text found in video"}), 404, headers
+    
+    except InvalidRequest:
+        raise
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    
+    finally:
+        # Clean up temporary files once the response is out
+        workspace.release(session)
+
+def parse_batch_texts(fields):
+    """Read the JSON array of texts of a batch encode request"""
+    try:
+        texts = json.loads(fields.get('texts', ''))
+    except ValueError:
+        raise InvalidRequest("texts must be a JSON array of strings")
+    if not isinstance(texts, list) or not all(isinstance(text, str) and text for text in texts):
+        raise InvalidRequest("texts must be a JSON array of strings")
+    if not 1 <= len(texts) <= MAX_BATCH_TEXTS:
+        raise InvalidRequest(f"A batch holds 1 to {MAX_BATCH_TEXTS} texts")
+    return texts
+
+@app.route('/encrypt/batch', methods=['POST'])
+@admission_controlled
+def encrypt_batch_endpoint():
+    """Hide several texts in copies of one video, returned together as a zip stream
+    
+    texts is a JSON array; the archive holds the outputs of every text in
+    order, named encoded_<name>_<index>.<format>, and a manifest.json.
+    """
+    # Every text gets its own outputs, so room is reserved for the largest batch
+    expected_bytes = request.content_length * MAX_BATCH_TEXTS if request.content_length else None
+    session = workspace.session(expected_bytes)
+    cleanup_deferred = False
+    
+    try:
+        upload = receive_upload(session.path)
+        texts = parse_batch_texts(upload.fields)
+        workers, formats, mode = parse_encode_options(upload.fields)
         
-        if border_data:
-            response_data["border_data"] = border_data
+        with span('rsa'):
+            encrypted_texts = [encrypt_rsa(text) for text in texts]
+        output_name = os.path.basename(output_base_path('', upload.filename))
+        variants = [(text, encrypted_text, os.path.join(session.path, f"{output_name}_{i}"))
+                    for i, (text, encrypted_text) in enumerate(zip(texts, encrypted_texts))]
+        output_paths, total_frames = encode_video_batch(upload.path, variants, formats, workers, mode)
         
-        if decrypted_text:
-            response_data["stego_data"] = decrypted_text
+        manifest = {"total_frames": total_frames, "variants": []}
+        entries = []
+        for i, (paths, encrypted_text) in enumerate(zip(output_paths, encrypted_texts)):
+            files = {fmt: os.path.basename(path) for fmt, path in paths.items()}
+            entries.extend((name, paths[fmt]) for fmt, name in files.items())
+            manifest["variants"].append({
+                "index": i,
+                "files": files,
+                "payload_frames": min(len(split_string(encrypted_text)), total_frames),
+            })
+        entries.insert(0, ('manifest.json', json.dumps(manifest, indent=2).encode('utf-8')))
         
-        if response_data:
-            return jsonify(response_data)
-        else:
-            return jsonify({"error": "No hidden text found in video"}), 404
+        # The archive is streamed after this function returns, remove the files once it is sent
+        response = stream_zip_response(entries, f"{output_name}.zip")
+        response.call_on_close(lambda: workspace.release(session))
+        cleanup_deferred = True
+        return response
+    
+    except InvalidRequest:
+        raise
+    
+    except FFmpegError as e:
+        return jsonify({"error": "Video encoding failed", "details": str(e)}), 500
     
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     
     finally:
-        # Clean up temporary files
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
+        if not cleanup_deferred:
+            workspace.release(session)
+
+# Asynchronous jobs
+# Long videos can take minutes, so the /jobs endpoints queue the work on a
+# bounded local pool and let clients poll for progress and fetch the result
+JOBS_FOLDER = os.environ.get('JOBS_FOLDER', './jobs')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 16))  # jobs allowed to wait for a worker
+JOB_RESULT_TTL = int(os.environ.get('JOB_RESULT_TTL', 3600))  # seconds results stay fetchable
+# Job directories count against the workspace quota; results are only swept once fetching them has expired
+workspace.add_folder(JOBS_FOLDER, max(WORKSPACE_ORPHAN_AGE, JOB_RESULT_TTL))
+
+JOB_STATE_FILE = 'job.json'
+JOB_SAVE_INTERVAL = 1.0  # seconds between progress writes to the state file
+JOB_SWEEP_INTERVAL = 60  # seconds between scans of JOBS_FOLDER for expired jobs
+
+class Job:
+    """State of one queued encode or decode
+    
+    The state is mirrored to job.json in the job's directory, so any worker
+    process sharing JOBS_FOLDER can report on it.
+    """
+    
+    def __init__(self, kind, work_dir):
+        self.id = os.path.basename(work_dir)
+        self.kind = kind
+        self.work_dir = work_dir
+        self.state = 'queued'
+        self.stage = 'queued'
+        self.done = None
+        self.total = None
+        self.result = None
+        self.error = None
+        self.created_at = datetime.now(timezone.utc)
+        self.finished_at = None
+        self._saved_at = 0.0
+    
+    def update(self, stage, done=None, total=None):
+        """Progress callback handed to the pipeline"""
+        self.stage = stage
+        self.done = done
+        self.total = total
+        if time.monotonic() - self._saved_at >= JOB_SAVE_INTERVAL:
+            self.save()
+    
+    def save(self):
+        """Write the state file"""
+        self._saved_at = time.monotonic()
+        state = {
+            "kind": self.kind, "state": self.state, "stage": self.stage,
+            "done": self.done, "total": self.total, "result": self.result, "error": self.error,
+            "created_at": self.created_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+        path = os.path.join(self.work_dir, JOB_STATE_FILE)
+        with open(f"{path}.tmp", 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(f"{path}.tmp", path)
+    
+    @classmethod
+    def load(cls, work_dir):
+        """Read a job from its state file, or None if there is none"""
+        try:
+            with open(os.path.join(work_dir, JOB_STATE_FILE)) as state_file:
+                state = json.load(state_file)
+        except (FileNotFoundError, ValueError):
+            return None
+        job = cls(state["kind"], work_dir)
+        for field in ('state', 'stage', 'done', 'total', 'result', 'error'):
+            setattr(job, field, state[field])
+        job.created_at = datetime.fromisoformat(state["created_at"])
+        if state["finished_at"]:
+            job.finished_at = datetime.fromisoformat(state["finished_at"])
+        return job
+    
+    def expired(self, now):
+        return self.finished_at is not None and (now - self.finished_at).total_seconds() > JOB_RESULT_TTL
+    
+    def to_dict(self):
+        percent = None
+        if self.state == 'done':
+            percent = 100.0
+        elif self.done is not None and self.total:
+            percent = round(min(self.done / self.total, 1.0) * 100, 1)
+        status = {
+            "id": self.id,
+            "kind": self.kind,
+            "state": self.state,
+            "stage": self.stage,
+            "progress": {"done": self.done, "total": self.total, "percent": percent},
+            "created_at": self.created_at.isoformat(),
+        }
+        if self.finished_at is not None:
+            status["finished_at"] = self.finished_at.isoformat()
+            status["expires_at"] = (self.finished_at + timedelta(seconds=JOB_RESULT_TTL)).isoformat()
+        if self.state == 'done':
+            status["result_url"] = f"/jobs/{self.id}/result"
+        if self.error is not None:
+            status["error"] = self.error
+        return status
+
+class JobManager:
+    """Runs jobs on a fixed pool of worker threads with a bounded backlog
+    
+    Jobs of this process are tracked in memory, jobs of other worker processes
+    are read from their state files. Finished jobs and their files are dropped
+    JOB_RESULT_TTL seconds after completion.
+    """
+    
+    def __init__(self, workers, queue_size):
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='job-worker')
+        self._capacity = workers + queue_size
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._swept_at = 0.0
+    
+    def has_capacity(self):
+        """Whether another job can be queued right now"""
+        with self._lock:
+            active = sum(1 for job in self._jobs.values() if job.state in ('queued', 'running'))
+        return active < self._capacity
+    
+    def submit(self, kind, work_dir, func, *args):
+        """Queue func(job, *args); returns the Job, or None when the backlog is full"""
+        self.expire()
+        with self._lock:
+            active = sum(1 for job in self._jobs.values() if job.state in ('queued', 'running'))
+            if active >= self._capacity:
+                return None
+            job = Job(kind, work_dir)
+            self._jobs[job.id] = job
+        job.save()
+        self._executor.submit(self._run, job, func, args)
+        return job
+    
+    def _run(self, job, func, args):
+        # The job stays queued until a work slot is free
+        _admission.acquire()
+        with _work_slot():
+            job.state = 'running'
+            job.save()
+            timer = start_timer()
+            try:
+                job.result = func(job, *args)
+                job.state = 'done'
+                job.stage = 'done'
+            except Exception as e:
+                print(f"[ERROR] Job {job.id} failed during {job.stage}: {e}")
+                job.state = 'failed'
+                job.error = str(e)
+            finally:
+                timer.observe()
+                job.finished_at = datetime.now(timezone.utc)
+                job.save()
+    
+    def get(self, job_id):
+        self.expire()
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and job_id == secure_filename(job_id):
+            job = Job.load(os.path.join(JOBS_FOLDER, job_id))
+            if job is not None and job.expired(datetime.now(timezone.utc)):
+                return None
+        return job
+    
+    def expire(self):
+        """Forget finished jobs past their TTL and delete their files"""
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            expired = [job for job in self._jobs.values() if job.expired(now)]
+            for job in expired:
+                del self._jobs[job.id]
+            sweep = time.monotonic() - self._swept_at >= JOB_SWEEP_INTERVAL
+            if sweep:
+                self._swept_at = time.monotonic()
+        for job in expired:
+            workspace.discard(job.work_dir)
+        
+        # Jobs finished by other worker processes, or before a restart
+        if sweep:
+            for name in os.listdir(JOBS_FOLDER):
+                job = Job.load(os.path.join(JOBS_FOLDER, name))
+                if job is not None and job.expired(now):
+                    workspace.discard(job.work_dir)
+
+job_manager = JobManager(JOB_WORKERS, JOB_QUEUE_SIZE)
+
+def _encrypt_job(job, video_path, text, workers, formats, mode):
+    output_path = output_base_path(os.path.dirname(video_path), os.path.basename(video_path))
+    output_paths, stats = encrypt_video_file(video_path, text, output_path, workers, formats, job.update, mode)
+    os.remove(video_path)  # Only the outputs are needed from here on
+    return {"outputs": output_paths, **stats}
+
+def _decrypt_job(job, video_path):
+    result = decrypt_video_file(video_path, job.update)
+    os.remove(video_path)
+    return result
+
+def submit_job(kind, func, options=None):
+    """Save the upload into a job directory and queue func(job, video_path, *options(fields))"""
+    if not job_manager.has_capacity():
+        response = jsonify({"error": "Too many jobs queued, try again later"})
+        response.headers['Retry-After'] = '30'
+        return response, 503
+    
+    work_dir = workspace.session(request.content_length, JOBS_FOLDER).path
+    try:
+        upload = receive_upload(work_dir)
+        args = options(upload.fields) if options is not None else ()
+        job = job_manager.submit(kind, work_dir, func, upload.path, *args)
+    except Exception:
+        workspace.discard(work_dir)
+        raise
+    
+    if job is None:
+        workspace.discard(work_dir)
+        response = jsonify({"error": "Too many jobs queued, try again later"})
+        response.headers['Retry-After'] = '30'
+        return response, 503
+    return jsonify(job.to_dict()), 202, {'Location': f"/jobs/{job.id}"}
+
+@app.route('/jobs/encrypt', methods=['POST'])
+def encrypt_job_endpoint():
+    """Queue an encrypt job and return its id right away"""
+    def options(fields):
+        if 'text' not in fields:
+            raise InvalidRequest("Missing video file or text")
+        workers, formats, mode = parse_encode_options(fields)
+        return fields['text'], workers, formats, mode
+    return submit_job('encrypt', _encrypt_job, options)
+
+@app.route('/jobs/decrypt', methods=['POST'])
+def decrypt_job_endpoint():
+    """Queue a decrypt job and return its id right away"""
+    return submit_job('decrypt', _decrypt_job)
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status_endpoint(job_id):
+    """Report the state, stage and frame progress of a job"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result_endpoint(job_id):
+    """Fetch the result of a finished job
+    
+    Encrypt jobs stream the video (pick one with ?format=, Range supported),
+    decrypt jobs return the same JSON as /decrypt.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+    if job.state == 'failed':
+        return jsonify({"error": job.error}), 500
+    if job.state != 'done':
+        return jsonify(job.to_dict()), 409
+    
+    if job.kind == 'decrypt':
+        if job.result:
+            return jsonify(job.result)
+        return jsonify({"error": "No hidden text found in video"}), 404
+    
+    outputs = job.result["outputs"]
+    fmt = request.args.get('format', next(iter(outputs)))
+    if fmt not in outputs:
+        return jsonify({"error": f"Job has no {fmt} output"}), 404
+    response = stream_file_response(outputs[fmt])
+    response.headers['X-Total-Frames'] = str(job.result["total_frames"])
+    response.headers['X-Payload-Frames'] = str(job.result["payload_frames"])
+    response.headers['Access-Control-Expose-Headers'] += ', X-Total-Frames, X-Payload-Frames'
+    return response
+
+@app.route('/healthz', methods=['GET'])
+def health_endpoint():
+    """Liveness probe: the process is up and serving requests"""
+    return jsonify({"status": "ok"})
+
+@app.route('/readyz', methods=['GET'])
+def ready_endpoint():
+    """Readiness probe: keys load, ffmpeg is installed and scratch space is writable"""
+    checks = {}
+    try:
+        keyring.active()
+        checks["keys"] = True
+    except Exception as e:
+        print(f"[ERROR] Keys not available: {e}")
+        checks["keys"] = False
+    checks["ffmpeg"] = shutil.which(FFMPEG_BINARY) is not None
+    checks["scratch"] = all(os.access(folder, os.W_OK) for folder in (workspace.root, JOBS_FOLDER))
+    
+    ready = all(checks.values())
+    with _in_flight_lock:
+        in_flight = _in_flight[0]
+    status = {"status": "ready" if ready else "not ready", "checks": checks,
+              "in_flight": in_flight, "capacity": MAX_CONCURRENT_WORK}
+    return jsonify(status), 200 if ready else 503
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Expose the counters and histograms in the Prometheus text format"""
+    values = metric_files.collect()
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render(values.get(metric.name, {})))
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['rotate-keys']:
+        rotate_keys()
+        sys.exit(0)
+    
     # Make sure keys are generated on startup
     generate_keys()
     
-    # Try different ports if the default is in use
-    port = 5000
-    max_port_attempts = 10
-    
-    for attempt in range(max_port_attempts):
-        try:
-            print(f"Attempting to start server on port {port}")
-            app.run(debug=True, host='0.0.0.0', port=port)
-            break
-        except OSError as e:
-            if "Address already in use" in str(e) and attempt < max_port_attempts - 1:
-                port += 1
-                print(f"Port {port-1} is in use, trying port {port}")
-            else:
-                print(f"Could not start server: {e}")
-                raise
\ No newline at end of file
+    # Development server; production runs wsgi.py under gunicorn (see gunicorn.conf.py)
+    port = int(os.environ.get('PORT', 5000))
+    print(f"Starting development server on port {port}")
+    app.run(debug=os.environ.get('FLASK_DEBUG', '1') == '1', host='0.0.0.0', port=port)
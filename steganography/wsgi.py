@@ -0,0 +1,12 @@
+"""WSGI entry point for production serving
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+With preload_app the master imports this once before forking, so the
+imports, key generation and key parsing are shared by every worker.
+"""
+from server import app, generate_keys, keyring
+
+# Make sure keys exist and are parsed before the workers fork
+generate_keys()
+keyring.refresh(force=True)